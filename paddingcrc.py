@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import itertools
+import struct
+import zlib
+
+
+def gf2_matrix_times(matrix, vector):
+    total = 0
+    row = 0
+    while vector:
+        if vector & 1:
+            total ^= matrix[row]
+        vector >>= 1
+        row += 1
+    return total
+
+
+def gf2_matrix_multiply(a, b):
+    """Returns the matrix applying b first, then a"""
+    return [gf2_matrix_times(a, column) for column in b]
+
+
+# Feeds one zero bit through the CRC-32 register
+_ZERO_BIT = [0xedb88320] + [1 << n for n in range(31)]
+_ZERO_BYTE = _ZERO_BIT
+for _ in range(3):
+    _ZERO_BYTE = gf2_matrix_multiply(_ZERO_BYTE, _ZERO_BYTE)
+
+
+def crc32_operator(length):
+    """Returns the matrix feeding length zero bytes through the CRC-32 register"""
+    result = [1 << n for n in range(32)]
+    square = _ZERO_BYTE
+    while length:
+        if length & 1:
+            result = gf2_matrix_multiply(square, result)
+        length >>= 1
+        if length:
+            square = gf2_matrix_multiply(square, square)
+    return result
+
+
+def crc32_combine(crc1, crc2, length2, operator=None):
+    """Returns the CRC-32 of a + b from crc1 of a, crc2 of b and the length of b"""
+    if operator is None:
+        operator = crc32_operator(length2)
+    return gf2_matrix_times(operator, crc1) ^ crc2
+
+
+class PaddingCRC(object):
+    """CRC-32 of prefix + padding_char * num + suffix for many values of num.
+
+    The CRC of the prefix and padding is extended from the previous call,
+    so a growing num costs one byte per step. The suffix is folded in with
+    a combine operator computed once for its length.
+    """
+
+    def __init__(self, prefix, suffix, padding_char):
+        self.prefix_crc = zlib.crc32(prefix)
+        self.suffix_crc = zlib.crc32(suffix)
+        self.suffix_length = len(suffix)
+        self.suffix_operator = crc32_operator(len(suffix))
+        self.padding_char = padding_char
+        self.num = 0
+        self.running_crc = self.prefix_crc
+
+    def crc(self, num):
+        if num < self.num:
+            self.num = 0
+            self.running_crc = self.prefix_crc
+        self.running_crc = zlib.crc32(
+            self.padding_char * (num - self.num), self.running_crc)
+        self.num = num
+        return crc32_combine(
+            self.running_crc,
+            self.suffix_crc,
+            self.suffix_length,
+            self.suffix_operator
+        )
+
+
+def affine_charset(charset):
+    """Returns (base, bits) such that base with any combination of the bits
+    flipped is in charset, with as many bits as possible"""
+    charset = frozenset(charset)
+    best = (None, [])
+    for base in sorted(charset):
+        span = [base]
+        bits = []
+        for bit in (1, 2, 4, 8, 16, 32, 64, 128):
+            if all(c ^ bit in charset for c in span):
+                span += [c ^ bit for c in span]
+                bits.append(bit)
+        if len(bits) > len(best[1]):
+            best = (base, bits)
+    return best
+
+
+def solve_gf2(columns, target):
+    """Returns a bitmask of columns xoring to target, or None"""
+    pivots = {}
+    for i, column in enumerate(columns):
+        combination = 1 << i
+        while column:
+            top = column.bit_length() - 1
+            if top not in pivots:
+                pivots[top] = (column, combination)
+                break
+            column ^= pivots[top][0]
+            combination ^= pivots[top][1]
+    combination = 0
+    while target:
+        top = target.bit_length() - 1
+        if top not in pivots:
+            return None
+        target ^= pivots[top][0]
+        combination ^= pivots[top][1]
+    return combination
+
+
+def forge_crc(data, offsets, charset, allowed, tries=4096):
+    """Fills the bytes of data at offsets from charset so that every byte of
+    the CRC-32 of data is allowed.
+
+    CRC-32 is affine in the bits of the data, so this is a linear system
+    over GF(2) in the bits the charset lets us flip. Returns the new data,
+    or None if no target CRC within the given number of tries is reachable.
+    """
+    base, bits = affine_charset(charset)
+    data = bytearray(data)
+    for offset in offsets:
+        data[offset] = base
+    crc = zlib.crc32(data)
+
+    # How flipping each controllable bit changes the CRC
+    flips = []
+    columns = []
+    for offset in offsets:
+        for bit in bits:
+            data[offset] ^= bit
+            columns.append(zlib.crc32(data) ^ crc)
+            data[offset] ^= bit
+            flips.append((offset, bit))
+
+    allowed = sorted(allowed)
+    for target in itertools.islice(itertools.product(allowed, repeat=4), tries):
+        combination = solve_gf2(columns, crc ^ struct.unpack('<L', bytes(target))[0])
+        if combination is not None:
+            for i, (offset, bit) in enumerate(flips):
+                if combination >> i & 1:
+                    data[offset] ^= bit
+            return data
+    return None
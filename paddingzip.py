@@ -1,6 +1,7 @@
 import os
 import argparse
 import io
+import mmap
 import struct
 from typing import Union
 from enum import Enum
@@ -28,8 +29,16 @@ class ZIPManipulation(object):
         self.prepend_size = len(prepend)
         self.append = append
         self.append_size = len(append)
+        # Parse and check the whole zip before anything is written
+        self.parse()
 
     def run(self):
+        return b''.join(self.parts())
+
+    def write(self, f):
+        f.writelines(self.parts())
+
+    def parse(self):
         while True:
             tag = self.reader.read(4)
             length = len(tag)
@@ -43,15 +52,24 @@ class ZIPManipulation(object):
             n = struct.unpack('<I', tag)
             self.next(n[0])
 
-        self.reader.seek(0)
-        data = self.reader.getvalue()
         for (index, offset) in self.prepend_table:
-            data = data[:index] + struct.pack('<I', offset + self.prepend_size) + data[index + 4:]
+            if offset + self.prepend_size > 0xffffffff:
+                raise Exception('offset does not fit in 32 bits after prepending')
+        for (index, size) in self.append_table:
+            if size + self.append_size > 0xffff:
+                raise Exception('the appended characters do not fit in the zip comment')
+
+    def parts(self):
+        """Returns the prepended bytes, the patched zip and the appended bytes"""
+        # Patch the offsets and the comment size in one copy of the zip
+        data = bytearray(self.reader.getbuffer())
+        for (index, offset) in self.prepend_table:
+            struct.pack_into('<I', data, index, offset + self.prepend_size)
 
         for (index, size) in self.append_table:
-            data = data[:index] + struct.pack('<H', size + self.append_size) + data[index + 2:]
+            struct.pack_into('<H', data, index, size + self.append_size)
 
-        return self.prepend + data + self.append
+        return self.prepend, data, self.append
 
     def next(self, tag: int):
         if tag == ZIPTag.S_ZIPFILERECORD.value:
@@ -70,7 +88,8 @@ class ZIPManipulation(object):
         compressed_size = struct.unpack('<I', self.reader.read(4))[0]
         self.reader.read(4)
         filename_size, extra_size = struct.unpack('<HH', self.reader.read(4))
-        self.reader.read(compressed_size + filename_size + extra_size)
+        # Skip the entry without copying it
+        self.reader.seek(compressed_size + filename_size + extra_size, io.SEEK_CUR)
 
     def zip_data_descr(self):
         self.reader.read(12)
@@ -89,10 +108,127 @@ class ZIPManipulation(object):
         self.reader.read(12)
         index = self.reader.tell()
         offset, comment_size = struct.unpack('<IH', self.reader.read(6))
+        self.reader.seek(comment_size, io.SEEK_CUR)
         self.prepend_table.append((index, offset))
         self.append_table.append((index + 4, comment_size))
 
 
+class StreamingZIPManipulation(object):
+    """Does what ZIPManipulation does, without loading the zip.
+
+    The zip is memory mapped, and its entries are found from the end of
+    central directory record instead of the local headers, so data
+    descriptors, ZIP64 and digital signatures are no problem. Every field
+    to patch is found and checked when the manipulation is created, and
+    write() copies the zip in chunks and patches the offsets on the way.
+    """
+
+    def __init__(self, filename: str, prepend: bytes, append: bytes, chunk_size: int = 1 << 20):
+        self.filename = filename
+        self.prepend = prepend
+        self.prepend_size = len(prepend)
+        self.append = append
+        self.append_size = len(append)
+        self.chunk_size = chunk_size
+        # A bad field found while writing would leave a truncated zip
+        data = self.map()
+        try:
+            self.patch_table = sorted(self.patches(data))
+        finally:
+            data.close()
+        for (index, fmt, _), (next_index, _, _) in zip(self.patch_table, self.patch_table[1:]):
+            if index + struct.calcsize(fmt) > next_index:
+                raise Exception('fields to patch overlap at %d' % next_index)
+
+    def map(self):
+        with open(self.filename, 'rb') as reader:
+            return mmap.mmap(reader.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def write(self, f):
+        data = self.map()
+        view = memoryview(data)
+        try:
+            f.write(self.prepend)
+            cursor = 0
+            for index, fmt, value in self.patch_table:
+                self.copy(f, data, view, cursor, index)
+                f.write(struct.pack(fmt, value))
+                cursor = index + struct.calcsize(fmt)
+            self.copy(f, data, view, cursor, len(data))
+            f.write(self.append)
+        finally:
+            view.release()
+            data.close()
+
+    def copy(self, f, data, view, start, end):
+        for index in range(start, end, self.chunk_size):
+            stop = min(index + self.chunk_size, end)
+            f.write(view[index:stop])
+            # Let the copied pages go, so that they do not add up
+            if hasattr(data, 'madvise') and hasattr(mmap, 'MADV_DONTNEED'):
+                page = index - index % mmap.PAGESIZE
+                data.madvise(mmap.MADV_DONTNEED, page, stop - page)
+
+    def patches(self, data):
+        """Yields (index, struct format, value) of every field to patch"""
+        # The end record is followed by a comment of at most 0xffff bytes
+        end = data.rfind(struct.pack('<I', ZIPTag.S_ZIPENDLOCATOR.value),
+                         max(0, len(data) - 22 - 0xffff))
+        if end < 0:
+            raise Exception('end of central directory not found')
+        directory_offset, comment_size = struct.unpack_from('<IH', data, end + 16)
+        end_offset = directory_offset
+
+        zip64 = None
+        locator = end - 20
+        if (locator >= 0 and
+                struct.unpack_from('<I', data, locator)[0] == ZIPTag.S_ZIP64ENDLOCATOR.value):
+            zip64 = struct.unpack_from('<Q', data, locator + 8)[0]
+            if struct.unpack_from('<I', data, zip64)[0] != ZIPTag.S_ZIP64ENDLOCATORRECORD.value:
+                raise Exception('ZIP64 end of central directory not found')
+            directory_offset = struct.unpack_from('<Q', data, zip64 + 48)[0]
+
+        index = directory_offset
+        while struct.unpack_from('<I', data, index)[0] == ZIPTag.S_ZIPDIRENTRY.value:
+            filename_size, extra_size, entry_comment_size, offset = \
+                struct.unpack_from('<HHH8xI', data, index + 28)
+            if offset == 0xffffffff:
+                yield self.zip64_offset(data, index, filename_size, extra_size)
+            else:
+                yield index + 42, '<I', self.shift32(offset)
+            index += 46 + filename_size + extra_size + entry_comment_size
+
+        if zip64 is not None:
+            yield zip64 + 48, '<Q', directory_offset + self.prepend_size
+            yield locator + 8, '<Q', zip64 + self.prepend_size
+        if end_offset != 0xffffffff:
+            yield end + 16, '<I', self.shift32(end_offset)
+        if comment_size + self.append_size > 0xffff:
+            raise Exception('the appended characters do not fit in the zip comment')
+        yield end + 20, '<H', comment_size + self.append_size
+
+    def zip64_offset(self, data, index, filename_size, extra_size):
+        # The ZIP64 extra field holds the sizes before the offset, but only
+        # the ones that did not fit in the central directory entry
+        compressed_size, uncompressed_size = struct.unpack_from('<II', data, index + 20)
+        extra = index + 46 + filename_size
+        while extra < index + 46 + filename_size + extra_size:
+            tag, size = struct.unpack_from('<HH', data, extra)
+            if tag == 0x0001:
+                field = extra + 4
+                field += 8 * (uncompressed_size == 0xffffffff)
+                field += 8 * (compressed_size == 0xffffffff)
+                offset = struct.unpack_from('<Q', data, field)[0]
+                return field, '<Q', offset + self.prepend_size
+            extra += 4 + size
+        raise Exception('ZIP64 extra field not found')
+
+    def shift32(self, offset):
+        if offset + self.prepend_size > 0xffffffff:
+            raise Exception('offset does not fit in 32 bits after prepending')
+        return offset + self.prepend_size
+
+
 def main():
     parser = argparse.ArgumentParser(
         description='A tool you can craft a zip file that contains the padding characters between the file content'
@@ -105,16 +241,22 @@ def main():
     parser.add_argument('-a',
                         '--append',
                         help='the characters that you want to append to the file')
+    parser.add_argument('-m',
+                        '--mmap',
+                        action='store_true',
+                        help='memory map the input and stream the output, for large or ZIP64 files')
     args = parser.parse_args()
 
-    with open(args.input, 'rb') as f:
-        data = f.read()
+    if args.mmap:
+        manipulation = StreamingZIPManipulation(args.input, args.prepend.encode(), args.append.encode())
+    else:
+        with open(args.input, 'rb') as f:
+            data = f.read()
 
-    manipulation = ZIPManipulation(data, args.prepend.encode(), args.append.encode())
-    data = manipulation.run()
+        manipulation = ZIPManipulation(data, args.prepend.encode(), args.append.encode())
 
     with open(args.output, 'wb') as f:
-        f.write(data)
+        manipulation.write(f)
 
     print('file %r is generated' % args.output)
 
@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import collections
+import heapq
+import itertools
+import os
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+from compress import ASCIICompressor, DistinctRuns, alphabet_profile
+from paddingcrc import PaddingCRC, forge_crc
+from validator import Alphabet
+
+# Header field checks, cheapest first
+STAGES = (
+    'RDL',     # raw data length, known before anything is done
+    'CRC',     # one pass over the raw data
+    'CDL',     # compressed data length, from a dry run of the compressor
+    'CDAFL',   # offset of the central directory, from the same dry run
+    'ENCODE',  # the compressed data itself
+)
+
+
+class SearchPlanner(object):
+    """Checks padding candidates against the jar header fields.
+
+    Every candidate is rejected at the first stage that fails, so the
+    expensive stages only run for candidates that passed the cheap ones.
+    """
+
+    def __init__(self, allowed, zip_entry_filename, cache=None):
+        self.allowed = frozenset(allowed)
+        # Translate table built once, for every field of every candidate
+        self.alphabet = Alphabet(self.allowed)
+        self.profile = alphabet_profile(allowed)
+        self.compressor = ASCIICompressor(self.profile, cache)
+        self.zip_entry_filename = zip_entry_filename
+        self.checked = 0
+        self.rejected = dict((stage, 0) for stage in STAGES)
+        self.last_rejection = None
+
+    def allows(self, value):
+        return self.alphabet.allows(struct.pack('<L', value % pow(2, 32)))
+
+    def check(self, raw_data, crc=None, runs=None):
+        """Returns the compressed data if every field passes, else None.
+        runs is passed on to the compressor."""
+        self.checked += 1
+        if not self.allows(len(raw_data)):
+            return self._reject('RDL')
+        if crc is None:
+            crc = zlib.crc32(raw_data)
+        if not self.allows(crc):
+            return self._reject('CRC')
+        if runs is None:
+            runs = DistinctRuns(raw_data)
+        compressed_size = self.compressor.compressed_size(raw_data, runs)
+        if not self.allows(compressed_size):
+            return self._reject('CDL')
+        if not self.allows(compressed_size + len(self.zip_entry_filename) + 0x1e):
+            return self._reject('CDAFL')
+        compressed_data = self.compressor.compress(raw_data, runs).data
+        if not self.alphabet.allows(compressed_data):
+            return self._reject('ENCODE')
+        self.last_rejection = None
+        return compressed_data
+
+    def fixed_disallowed(self, raw_data, runs=None):
+        """Describes the first disallowed byte of the compressed data if it
+        lies in the header and tables of a block, or in a padding block.
+        Those bytes come from the fixed parts of the encoder, so no other
+        padding can change them. Returns None otherwise."""
+        blocks = []
+        compressor = ASCIICompressor(self.profile, self.compressor.cache, stats=blocks.append)
+        compressed_data = compressor.compress(raw_data, runs).data
+        offset = self.alphabet.first_disallowed(compressed_data)
+        if offset < 0:
+            return None
+        start = 0
+        for number, block in enumerate(blocks):
+            header_end = start + block.padding_bits + block.header_bits
+            # The byte must not share bits with the data around the header
+            if start <= 8 * offset and 8 * offset + 8 <= header_end:
+                return 'byte 0x%02x at offset %d is in the fixed header of block %d' % (
+                    compressed_data[offset], offset, number)
+            start = header_end + block.data_bits
+        return None
+
+    def record(self, stage):
+        """Counts a candidate that was checked somewhere else"""
+        self.checked += 1
+        if stage is not None:
+            self.rejected[stage] += 1
+        self.last_rejection = stage
+
+    def _reject(self, stage):
+        self.rejected[stage] += 1
+        self.last_rejection = stage
+        return None
+
+    def report(self):
+        return '[*] Checked {0} candidates, rejected by {1}'.format(
+            self.checked,
+            ' '.join('{0}:{1}'.format(stage, self.rejected[stage]) for stage in STAGES)
+        )
+
+
+class PaddingTemplate(object):
+    """A payload with a run of padding characters in place of a placeholder.
+
+    The placeholder may appear several times. Each one is a site the
+    padding can go to, and the other ones are left empty.
+    """
+
+    def __init__(self, text, padding_char='A', placeholder='{PADDING_DATA}'):
+        self.parts = [part.encode() for part in text.split(placeholder)]
+        if len(self.parts) < 2:
+            raise Exception('placeholder %r not found' % placeholder)
+        self.sites = len(self.parts) - 1
+        self.prefix, self.suffix = self.site(0)
+        self.padding_char = padding_char.encode()
+        self.padding_offset = len(self.prefix)
+        self._crcs = {}
+
+    def site(self, site):
+        """Returns the bytes before and after the padding at site"""
+        return b''.join(self.parts[:site+1]), b''.join(self.parts[site+1:])
+
+    def length(self, num):
+        return len(self.prefix) + num + len(self.suffix)
+
+    def render(self, num, padding_char=None, site=0):
+        prefix, suffix = self.site(site)
+        return bytearray(prefix + (padding_char or self.padding_char) * num + suffix)
+
+    def crc(self, num, padding_char=None, site=0):
+        key = (padding_char or self.padding_char, site)
+        if key not in self._crcs:
+            prefix, suffix = self.site(site)
+            self._crcs[key] = PaddingCRC(prefix, suffix, key[0])
+        return self._crcs[key].crc(num)
+
+
+# The state of a pool worker process, set by its initializer
+_worker = None
+
+
+def _start_worker(build, crc, allowed, zip_entry_filename):
+    global _worker
+    _worker = (build, crc, SearchPlanner(allowed, zip_entry_filename))
+
+
+def _check_candidate(candidate, worker=None):
+    build, crc, planner = worker or _worker
+    compressed_data = planner.check(
+        build(*candidate), None if crc is None else crc(*candidate))
+    return compressed_data, planner.last_rejection
+
+
+def _check_in_order(build, allowed, zip_entry_filename, candidates, workers=None, crc=None):
+    """Checks the payloads build(*candidate) for every candidate tuple in
+    parallel, and yields (candidate, compressed data, rejection stage) in
+    the order of candidates."""
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        # Kept out of _worker, so that searches in the same process do not
+        # overwrite each other's planner
+        worker = (build, crc, SearchPlanner(allowed, zip_entry_filename))
+        for candidate in candidates:
+            yield (candidate,) + _check_candidate(candidate, worker)
+        return
+
+    executor = ProcessPoolExecutor(
+        workers,
+        initializer=_start_worker,
+        initargs=(build, crc, allowed, zip_entry_filename)
+    )
+    pending = collections.deque()
+    candidates = iter(candidates)
+    try:
+        while True:
+            # Keep every worker busy while the results are read in order
+            for candidate in itertools.islice(candidates, workers * 4 - len(pending)):
+                pending.append((candidate, executor.submit(_check_candidate, candidate)))
+            if not pending:
+                break
+            candidate, future = pending.popleft()
+            yield (candidate,) + future.result()
+    finally:
+        for _, future in pending:
+            future.cancel()
+        executor.shutdown()
+
+
+def parallel_search(build, allowed, zip_entry_filename, start=1, workers=None, crc=None,
+                    stop=None):
+    """Checks the payloads build(start), build(start+1), ... in parallel,
+    up to build(stop-1) if stop is given.
+
+    Yields (num, compressed data, rejection stage) in the order of num, so
+    the first candidate with compressed data is the smallest passing one.
+    Candidates still queued are cancelled when the caller stops iterating.
+    build (and crc, which returns the CRC-32 of build(num) if given) must
+    be picklable, e.g. the methods of a PaddingTemplate.
+    """
+    nums = itertools.count(start) if stop is None else range(start, stop)
+    candidates = ((num,) for num in nums)
+    for (num,), compressed_data, rejection in _check_in_order(
+            build, allowed, zip_entry_filename, candidates, workers, crc):
+        yield num, compressed_data, rejection
+
+
+def padding_frontier(padding_chars, sites, start=1, allows_length=None, stop=None):
+    """Yields (num, padding char, site) candidates, cheapest first.
+
+    A candidate costs its padding length, ties go to the earlier padding
+    char and site. Every (padding char, site) pair keeps its next length
+    on a heap, and lengths that allows_length rejects are skipped, as no
+    padding char or site can fix the RDL field. Lengths from stop on are
+    not yielded.
+    """
+    def next_num(num):
+        while (allows_length is not None and (stop is None or num < stop) and
+               not allows_length(num)):
+            num += 1
+        return num
+
+    num = next_num(start)
+    frontier = [
+        (num, char_index, site_index)
+        for char_index in range(len(padding_chars))
+        for site_index in range(len(sites))
+    ]
+    heapq.heapify(frontier)
+    while frontier:
+        num, char_index, site_index = heapq.heappop(frontier)
+        if stop is not None and num >= stop:
+            break
+        yield num, padding_chars[char_index], sites[site_index]
+        heapq.heappush(frontier, (next_num(num + 1), char_index, site_index))
+
+
+def frontier_search(template, allowed, zip_entry_filename, padding_chars, sites=None,
+                    start=1, workers=None, stop=None):
+    """Searches the padding length, the padding char and the padding site
+    together.
+
+    The CRC changes with every padding char and site, and the compressed
+    length with every padding char, so a length with an allowed RDL
+    usually has a passing candidate among them, where parallel_search has
+    to wait for a lucky length. padding_chars are byte strings of one byte
+    that the template can hold, and sites defaults to all of them. Yields
+    (num, padding char, site, compressed data, rejection stage), cheapest
+    first, so the caller can stop at the first one with compressed data.
+    Padding lengths from stop on are not tried.
+    """
+    planner = SearchPlanner(allowed, zip_entry_filename)
+    if sites is None:
+        sites = range(template.sites)
+    candidates = padding_frontier(
+        list(padding_chars), list(sites), start,
+        lambda num: planner.allows(template.length(num)), stop)
+    for candidate, compressed_data, rejection in _check_in_order(
+            template.render, allowed, zip_entry_filename, candidates, workers, template.crc):
+        yield candidate + (compressed_data, rejection)
+
+
+def batch_search(template, alphabets, zip_entry_filename, start=1, stop=0x10000, cache=None):
+    """Searches the shortest passing padding for several alphabets at once.
+
+    Every padding length is rendered and its CRC computed once for all
+    the alphabets still searching, and their compressors share one
+    DistinctRuns of the payload and one HuffmanCache. Returns, for every
+    alphabet, (num, raw data, compressed data, None), or (None, None,
+    None, reason) if no padding below stop passes, the payload can not be
+    encoded with it, or the encoder puts a disallowed byte in a fixed
+    header.
+    """
+    planners = [SearchPlanner(allowed, zip_entry_filename, cache) for allowed in alphabets]
+    results = [None] * len(alphabets)
+    num = start
+    while num < stop and None in results:
+        searching = [
+            index for index, result in enumerate(results)
+            if result is None and planners[index].allows(template.length(num))
+        ]
+        if searching:
+            raw_data = template.render(num)
+            crc = template.crc(num)
+            runs = DistinctRuns(raw_data)
+        for index in searching:
+            planner = planners[index]
+            try:
+                compressed_data = planner.check(raw_data, crc, runs)
+            except ValueError as e:
+                # _choose_chunk() found a byte that no block can hold
+                results[index] = (None, None, None, 'can not encode the payload: %s' % e)
+                continue
+            if compressed_data is not None:
+                results[index] = (num, raw_data, compressed_data, None)
+            elif planner.last_rejection == 'ENCODE':
+                reason = planner.fixed_disallowed(raw_data, runs)
+                if reason is not None:
+                    results[index] = (None, None, None, reason)
+        num += 1
+    return [
+        result or (None, None, None, 'no padding below %d passes' % stop)
+        for result in results
+    ]
+
+
+def solve_search(template, allowed, zip_entry_filename, charset, free_bytes=12, start=1,
+                 stop=None):
+    """Builds passing payloads instead of waiting for a lucky CRC.
+
+    The last free_bytes bytes of the padding are chosen from charset by
+    forge_crc() so that the CRC is allowed, which leaves only the length
+    fields to the search over num. Yields (num, raw data, compressed data,
+    rejection stage) in the order of num, up to stop-1 if stop is given.
+    """
+    planner = SearchPlanner(allowed, zip_entry_filename)
+    num = max(start, free_bytes)
+    while stop is None or num < stop:
+        raw_data = template.render(num)
+        if planner.allows(len(raw_data)):
+            end = template.padding_offset + num
+            raw_data = forge_crc(raw_data, range(end - free_bytes, end), charset, allowed)
+        if raw_data is None:
+            planner.record('CRC')
+            yield num, None, None, 'CRC'
+        else:
+            compressed_data = planner.check(raw_data)
+            yield num, raw_data, compressed_data, planner.last_rejection
+        num += 1
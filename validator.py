@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+from __future__ import print_function
+
+import io
+import struct
+import zipfile
+import zlib
+
+
+class Alphabet(object):
+    """Checks whole buffers against the allowed bytes.
+
+    Buffers are mapped through a 256 entry table with bytes.translate, so
+    the check runs at C speed instead of byte by byte in Python.
+    """
+
+    def __init__(self, allowed):
+        self.allowed = frozenset(allowed)
+        # Allowed bytes become 0, the others 1
+        self.table = bytes(0 if b in self.allowed else 1 for b in range(256))
+
+    def first_disallowed(self, data):
+        """Returns the offset of the first byte that is not allowed, or -1"""
+        return bytes(data).translate(self.table).find(1)
+
+    def allows(self, data):
+        return self.first_disallowed(data) < 0
+
+
+def verify_jar(jar_data, entries, allowed=None):
+    """Checks that jar_data unpacks to exactly the given entries.
+
+    entries maps filenames to raw data. Every entry is read with zipfile,
+    which also checks the CRC, and is inflated again with zlib straight
+    from its local header, which must end the deflate stream exactly at
+    the compressed size. If allowed is given, every byte of the jar must
+    be in it. Raises an Exception describing the first problem found.
+    """
+    if allowed is not None:
+        offset = Alphabet(allowed).first_disallowed(jar_data)
+        if offset >= 0:
+            raise Exception('byte 0x%02x at offset %d is not allowed' % (jar_data[offset], offset))
+
+    jar = zipfile.ZipFile(io.BytesIO(bytes(jar_data)))
+    names = set(info.filename for info in jar.infolist())
+    expected = set(
+        filename if isinstance(filename, str) else filename.decode()
+        for filename in entries
+    )
+    if names != expected:
+        raise Exception('entries %r instead of %r' % (sorted(names), sorted(expected)))
+
+    for filename, raw_data in entries.items():
+        if not isinstance(filename, str):
+            filename = filename.decode()
+        info = jar.getinfo(filename)
+        if jar.read(info) != bytes(raw_data):
+            raise Exception('%s does not unpack to its raw data' % filename)
+
+        magic, filename_size, extra_size = struct.unpack_from(
+            '<I22xHH', jar_data, info.header_offset)
+        if magic != 0x04034b50:
+            raise Exception('%s has no local header at offset %d' % (filename, info.header_offset))
+        start = info.header_offset + 30 + filename_size + extra_size
+        decompressor = zlib.decompressobj(-15)
+        data = decompressor.decompress(bytes(jar_data[start:start+info.compress_size]))
+        data += decompressor.flush()
+        if not decompressor.eof or decompressor.unused_data or data != bytes(raw_data):
+            raise Exception('%s is not a complete deflate stream of its raw data' % filename)